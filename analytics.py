@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ClickRecorder:
+    """Write-behind click counter for the redirect path.
+
+    Clicks are aggregated in memory into per-link, per-minute counters and
+    written by a background thread every ``interval`` seconds, or sooner
+    once ``flush_size`` counters are pending. ``record`` never touches the
+    database or waits on I/O. When ``max_pending`` distinct counters are
+    already buffered, clicks for new counters are dropped and counted in
+    ``dropped``.
+    """
+
+    def __init__(self, storage, interval=1.0, flush_size=1000, max_pending=10000):
+        self.storage = storage
+        self.interval = interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.flushed = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, url_id, now=None):
+        key = (url_id, int((now or time.time()) // 60) * 60)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] += 1
+            elif len(self._pending) < self.max_pending:
+                self._pending[key] = 1
+            else:
+                self.dropped += 1
+                return
+            size = len(self._pending)
+        if self._thread is None:
+            self.start()
+        if size >= self.flush_size:
+            self._wakeup.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='click-recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush click counters')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            self.storage.record_clicks(pending)
+        except Exception:
+            self._restore(pending)
+            raise
+        self.flushed += len(pending)
+        return len(pending)
+
+    def _restore(self, pending):
+        with self._lock:
+            for key, count in pending.items():
+                if key in self._pending:
+                    self._pending[key] += count
+                elif len(self._pending) < self.max_pending:
+                    self._pending[key] = count
+                else:
+                    self.dropped += count
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), "flushed": self.flushed, "dropped": self.dropped}
@@ -1,75 +1,476 @@
-import random
+import atexit
+import click
+import json
 import sqlite3
-from flask import Flask, redirect, render_template, request, jsonify
+import hashlib
+import hmac
+import itertools
+import time
+from datetime import datetime, timezone
+from flask import (Flask, Response, g, redirect, render_template, request, jsonify, send_from_directory,
+                   stream_with_context, url_for)
+import metrics
+import normalize
+from analytics import ClickRecorder
+from bloom import ShortCodeFilter
+from cache import LRUCache
+from coherence import ChangeWatcher
+from database import Database
+from migrations import rehash
+from expiry import LinkReaper
+from groupcommit import GroupCommitWriter
+from profiling import PROFILE_NAME, RequestProfiler
+from ratelimit import LoadShedder, TokenBuckets, retry_after
+from shortcodes import create_generator, random_code
+from snapshot import SnapshotRedirects, build_snapshot
+from storage import create_storage
+import prefork
+import transfer
 
 app = Flask(__name__, template_folder='templates')
+app.config.update(
+    DATABASE='data.db',
+    STORAGE_BACKEND='sqlite',
+    STORAGE_SHARDS=4,
+    DB_POOL_SIZE=8,
+    DB_READ_POOL_SIZE=8,
+    DB_JOURNAL_MODE='WAL',
+    DB_SYNCHRONOUS='NORMAL',
+    DB_CACHE_SIZE=-16000,
+    DB_MMAP_SIZE=268435456,
+    DB_BUSY_TIMEOUT=5000,
+    REDIRECT_CACHE_SIZE=1024,
+    REDIRECT_CACHE_TTL=None,
+    REDIRECT_STATUS=302,
+    REDIRECT_MAX_AGE=None,
+    SHORTCODE_GENERATOR='sequence',
+    SHORTCODE_LENGTH=6,
+    SHORTCODE_BLOCK_SIZE=1000,
+    SHORTCODE_ATTEMPTS=5,
+    INDEX_PAGE_SIZE=50,
+    API_PAGE_SIZE=100,
+    API_MAX_PAGE_SIZE=1000,
+    API_STREAM_BATCH_SIZE=500,
+    API_BATCH_MAX_SIZE=50000,
+    CLICK_ANALYTICS=True,
+    CLICK_FLUSH_INTERVAL=1.0,
+    CLICK_FLUSH_SIZE=1000,
+    CLICK_MAX_PENDING=10000,
+    CLICK_STATS_MAX_MINUTES=7 * 24 * 60,
+    SHORTCODE_FILTER=False,
+    SHORTCODE_FILTER_ERROR_RATE=0.001,
+    METRICS_ENABLED=True,
+    REDIRECT_SNAPSHOT=None,
+    SNAPSHOT_CHECK_INTERVAL=5.0,
+    SNAPSHOT_DELTA_INTERVAL=5.0,
+    SNAPSHOT_FALLBACK=True,
+    ADMIN_TOKEN=None,
+    PROFILE_SAMPLE_RATE=0.0,
+    PROFILE_HEADER='X-Profile',
+    PROFILE_DIR=None,
+    PROFILE_MAX_FILES=100,
+    ASGI_MAX_WORKERS=32,
+    CHANGE_POLL_INTERVAL=1.0,
+    CHANGE_LOG_RETENTION=86400,
+    EXPIRY_REAP_INTERVAL=60.0,
+    EXPIRY_REAP_BATCH_SIZE=500,
+    EXPIRY_VACUUM_PAGES=1000,
+    GROUP_COMMIT=False,
+    GROUP_COMMIT_WINDOW=0.002,
+    GROUP_COMMIT_MAX_BATCH=256,
+    URL_NORMALIZATION=list(normalize.DEFAULT_STEPS),
+    RATE_LIMITS={},
+    RATE_LIMIT_KEY_HEADER='X-API-Key',
+    RATE_LIMIT_MAX_CLIENTS=10000,
+    SHED_MAX_IN_FLIGHT=None,
+    SHED_MAX_LATENCY=None,
+    SHED_ENDPOINTS=['index', 'api_create_url', 'api_create_urls_batch', 'api_get_urls'],
+    SHED_EXEMPT_ENDPOINTS=['redirect_shorturl', 'metrics_endpoint'],
+    SHED_RETRY_AFTER=1,
+)
+app.config.from_prefixed_env()
+normalize.configure(app.config['URL_NORMALIZATION'])
 
-def get_db_connection():
-    db = sqlite3.connect('data.db')
-    db.row_factory = sqlite3.Row
-    return db
+# Statements only need the instrumented cursor when something reads the
+# timings: the metrics, or a profile when profiling can be triggered.
+metrics.InstrumentedCursor.observe = app.config['METRICS_ENABLED']
+database = Database(app, connection_factory=metrics.InstrumentedConnection
+                    if app.config['METRICS_ENABLED'] or app.config['PROFILE_SAMPLE_RATE'] or app.config['ADMIN_TOKEN']
+                    else sqlite3.Connection)
+atexit.register(database.close)
+
+code_generator = create_generator(
+    app.config['SHORTCODE_GENERATOR'],
+    length=app.config['SHORTCODE_LENGTH'],
+    block_size=app.config['SHORTCODE_BLOCK_SIZE'],
+)
+
+storage = create_storage(app, database, code_generator)
+atexit.register(storage.close)
+
+redirect_cache = LRUCache(app.config['REDIRECT_CACHE_SIZE'], app.config['REDIRECT_CACHE_TTL'])
+
+click_recorder = ClickRecorder(
+    storage,
+    interval=app.config['CLICK_FLUSH_INTERVAL'],
+    flush_size=app.config['CLICK_FLUSH_SIZE'],
+    max_pending=app.config['CLICK_MAX_PENDING'],
+)
+atexit.register(click_recorder.stop)
+
+shortcode_filter = ShortCodeFilter(storage, app.config['SHORTCODE_FILTER_ERROR_RATE'])
+
+def create_links(longurls, hashes, settings):
+    # The writer thread has no request, so it needs its own app context
+    with app.app_context():
+        return storage.create_many(longurls, hashes, settings)
+
+group_writer = GroupCommitWriter(
+    create_links,
+    window=app.config['GROUP_COMMIT_WINDOW'],
+    max_batch=app.config['GROUP_COMMIT_MAX_BATCH'],
+)
+atexit.register(group_writer.stop)
+
+def create_link(longurl, **settings):
+    """Shorten one URL, through the group-commit writer when enabled."""
+    if app.config['GROUP_COMMIT']:
+        return group_writer.create(longurl, **settings)
+    return storage.create(longurl, **settings)
+
+snapshot_redirects = None
+if app.config['REDIRECT_SNAPSHOT']:
+    snapshot_redirects = SnapshotRedirects(
+        app.config['REDIRECT_SNAPSHOT'],
+        storage,
+        check_interval=app.config['SNAPSHOT_CHECK_INTERVAL'],
+        delta_interval=app.config['SNAPSHOT_DELTA_INTERVAL'],
+    )
+
+metrics.GaugeCallback('redirect_cache_events', 'Redirect cache hits, misses and evictions.',
+                      lambda: {(name,): value for name, value in redirect_cache.stats().items()
+                               if name in ('hits', 'misses', 'evictions', 'size')}, ('event',))
+metrics.GaugeCallback('click_recorder_events', 'Click counters pending, flushed and dropped.',
+                      lambda: {(name,): value for name, value in click_recorder.stats().items()}, ('event',))
+metrics.GaugeCallback('group_commit_events', 'Creates queued, coalesced and committed by the group-commit writer.',
+                      lambda: {(name,): value for name, value in group_writer.stats().items()}, ('event',))
+metrics.GaugeCallback('shortcode_filter_rejected', 'Lookups rejected by the short code filter.',
+                      lambda: {(): shortcode_filter.rejected})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None and app.config['METRICS_ENABLED']:
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started,
+                                         (request.endpoint or 'unmatched', request.method, str(response.status_code)))
+    return response
+
+profiler = RequestProfiler(app)
+
+rate_limiter = TokenBuckets(app.config['RATE_LIMIT_MAX_CLIENTS'])
+load_shedder = LoadShedder(app.config['SHED_MAX_IN_FLIGHT'], app.config['SHED_MAX_LATENCY'])
+metrics.GaugeCallback('load_shedder_state', 'Requests in flight and waiting, and the latency moving average.',
+                      lambda: {(name,): value for name, value in load_shedder.stats().items()}, ('measure',))
+
+def client_key(api_key, remote_addr):
+    """Rate limit key: the API key if one was sent, else the client address."""
+    return f'key:{api_key}' if api_key else f'ip:{remote_addr}'
+
+def refusal(endpoint, key):
+    """Response to refuse a request to ``endpoint`` from client ``key`` with, or None.
+
+    While overloaded, the routes in ``SHED_ENDPOINTS`` are refused; at twice
+    the threshold every route but ``SHED_EXEMPT_ENDPOINTS`` is, so
+    redirects keep flowing. Then the route's rate limit applies.
+    """
+    level = load_shedder.level()
+    if level and endpoint not in app.config['SHED_EXEMPT_ENDPOINTS'] \
+            and (level > 1 or endpoint in app.config['SHED_ENDPOINTS']):
+        return refuse(endpoint, 503, "Server is overloaded", app.config['SHED_RETRY_AFTER'], 'overloaded')
+    limit = app.config['RATE_LIMITS'].get(endpoint)
+    if limit:
+        wait = rate_limiter.take((endpoint, key), *limit)
+        if wait:
+            return refuse(endpoint, 429, "Rate limit exceeded", wait, 'rate_limited')
+    return None
+
+def refuse(endpoint, status, error, seconds, reason):
+    if app.config['METRICS_ENABLED']:
+        metrics.REQUESTS_REFUSED.inc((endpoint, reason))
+    response = jsonify({"error": error})
+    response.status_code = status
+    response.headers['Retry-After'] = retry_after(seconds)
+    return response
+
+@app.before_request
+def admit_request():
+    """Refuse the request if shedding load or over its rate limit, else count it in flight."""
+    response = refusal(request.endpoint,
+                       client_key(request.headers.get(app.config['RATE_LIMIT_KEY_HEADER']), request.remote_addr))
+    if response is not None:
+        return response
+    load_shedder.enter()
+    g.admitted_at = time.perf_counter()
+
+@app.teardown_request
+def release_request(exc=None):
+    admitted_at = g.pop('admitted_at', None)
+    if admitted_at is not None:
+        load_shedder.exit(time.perf_counter() - admitted_at)
+
+def get_db_connection(readonly=False):
+    return database.connection(readonly)
 
 def randomString(cursor, length=6):
-    letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-    while True:
-        result_str = ''.join(random.choice(letters) for _ in range(length))
-        cursor.execute('SELECT shorturl FROM urls WHERE shorturl = ?', (result_str,))
-        if not cursor.fetchone():
-            return result_str
+    return random_code(cursor, length)
+
+def int_arg(name, default=None):
+    """Read a non-negative integer query parameter; raises ValueError."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+def invalidate_redirect(shorturl_code):
+    redirect_cache.invalidate(shorturl_code)
+    if snapshot_redirects is not None:
+        snapshot_redirects.invalidate(shorturl_code)
+
+change_watcher = ChangeWatcher(
+    storage.databases(),
+    invalidate_redirect,
+    redirect_cache.clear,
+    interval=app.config['CHANGE_POLL_INTERVAL'],
+    retention=app.config['CHANGE_LOG_RETENTION'],
+)
+atexit.register(change_watcher.close)
+metrics.GaugeCallback('change_watcher_events', 'Redirects evicted for changes made by other processes.',
+                      lambda: {(name,): change_watcher.stats()[name] for name in ('invalidated', 'resets')},
+                      ('event',))
+
+link_reaper = LinkReaper(
+    storage,
+    invalidate_redirect,
+    interval=app.config['EXPIRY_REAP_INTERVAL'],
+    batch_size=app.config['EXPIRY_REAP_BATCH_SIZE'],
+    vacuum_pages=app.config['EXPIRY_VACUUM_PAGES'],
+)
+atexit.register(link_reaper.stop)
+metrics.GaugeCallback('link_reaper_events', 'Expired links deleted and database pages reclaimed.',
+                      lambda: {(name,): value for name, value in link_reaper.stats().items()}, ('event',))
+
+@app.before_request
+def start_link_reaper():
+    link_reaper.start()
+
+REDIRECT_STATUSES = (301, 302, 307, 308)
+# One year, the longest max-age caches are expected to honour
+MAX_CACHE_MAX_AGE = 365 * 24 * 3600
+# 9999-12-31T23:59:59Z, the last second ISO 8601 dates can name
+MAX_EXPIRES_AT = 253402300799
+
+def link_settings(data):
+    """Per-link redirect settings present in a JSON body; raises ValueError.
+
+    ``null`` resets a setting to the app-wide default.
+    """
+    settings = {}
+    if 'redirect_status' in data:
+        status = data['redirect_status']
+        if status is not None and (type(status) is not int or status not in REDIRECT_STATUSES):
+            raise ValueError('redirect_status must be one of 301, 302, 307 or 308')
+        settings['redirect_status'] = status
+    if 'cache_max_age' in data:
+        max_age = data['cache_max_age']
+        if max_age is not None and (type(max_age) is not int or not 0 <= max_age <= MAX_CACHE_MAX_AGE):
+            raise ValueError(f'cache_max_age must be an integer from 0 to {MAX_CACHE_MAX_AGE}')
+        settings['cache_max_age'] = max_age
+    if 'expires_at' in data and 'expires_in' in data:
+        raise ValueError('Pass either expires_at or expires_in, not both')
+    if 'expires_in' in data:
+        ttl = data['expires_in']
+        if ttl is not None and (type(ttl) is not int or ttl <= 0):
+            raise ValueError('expires_in must be a positive number of seconds')
+        if ttl is not None and int(time.time()) + ttl > MAX_EXPIRES_AT:
+            raise ValueError('expires_in must end before the year 10000')
+        settings['expires_at'] = None if ttl is None else int(time.time()) + ttl
+    elif 'expires_at' in data:
+        settings['expires_at'] = parse_expiry(data['expires_at'])
+    return settings
+
+def parse_expiry(value):
+    """Unix time for an ``expires_at`` given as seconds or ISO 8601; raises ValueError.
+
+    Times without an offset are taken as UTC.
+    """
+    if value is None:
+        return None
+    if type(value) is int:
+        expires_at = value
+    elif isinstance(value, str):
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError('expires_at must be a Unix time or an ISO 8601 date') from None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        expires_at = int(moment.timestamp())
+    else:
+        raise ValueError('expires_at must be a Unix time or an ISO 8601 date')
+    if expires_at <= time.time():
+        raise ValueError('expires_at must be in the future')
+    if expires_at > MAX_EXPIRES_AT:
+        raise ValueError('expires_at must be before the year 10000')
+    return expires_at
+
+def link_etag(row):
+    """ETag of one link. Ids of deleted links can be reused, so the code and
+    creation-or-update time tell a recreated link from the old one."""
+    digest = hashlib.blake2b(f'{row[2]}:{row[6]}'.encode(), digest_size=6).hexdigest()
+    return f'{row[0]}-{row[5]}-{digest}'
+
+def set_validators(response, etag, updated_at=None):
+    response.set_etag(etag, weak=True)
+    if updated_at is not None:
+        response.last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+    return response
+
+def not_modified(etag, updated_at=None):
+    """A 304 response if the client's cached copy is current, else None.
+
+    Checked before the body is built, so a revalidation only costs the row
+    lookup. ``If-None-Match`` takes precedence over ``If-Modified-Since``.
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (updated_at is not None and request.if_modified_since is not None
+                 and datetime.fromtimestamp(updated_at, timezone.utc) <= request.if_modified_since)
+    return set_validators(Response(status=304), etag, updated_at) if fresh else None
+
+def url_json(row, host_url):
+    return {"id": row[0], "longurl": row[1], "shorturl": row[2], "access_url": f"{host_url}{row[2]}",
+            "redirect_status": row[3], "cache_max_age": row[4], "expires_at": row[7]}
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    db = get_db_connection()
-    cursor = db.cursor()
-
-    cursor.execute('CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, longurl TEXT, shorturl TEXT UNIQUE)')
-    cursor.execute('SELECT id, longurl, shorturl FROM urls')
-    all_urls = cursor.fetchall()
-    urls_list = [{"id": row[0], "longurl": row[1], "shorturl": row[2], "access_url": f"{request.host_url}{row[2]}"} for row in all_urls]
+    context = {}
 
     if request.method == 'POST':
         longurl = request.form.get('longurl')
+        expires_in = request.form.get('expires_in')
+        try:
+            settings = link_settings({'expires_in': int(expires_in)}) if expires_in else {}
+        except ValueError:
+            settings = None
         if not longurl:
-            db.close()
-            return render_template('index.html', error='Please enter a URL', all_urls=urls_list)
-
-        cursor.execute('SELECT shorturl FROM urls WHERE longurl = ?', (longurl,))
-        result = cursor.fetchone()
-
-        if result:
-            db.close()
-            return render_template('index.html', host=request.host_url, shorturl=result[0], all_urls=urls_list)
+            context['error'] = 'Please enter a URL'
+        elif settings is None:
+            context['error'] = 'Please choose a valid expiry'
         else:
-            shorturl_code = randomString(cursor)
-            cursor.execute('INSERT INTO urls (longurl, shorturl) VALUES (?, ?)', (longurl, shorturl_code))
-            db.commit()
-            db.close()
-            return render_template('index.html', host=request.host_url, shorturl=shorturl_code, all_urls=urls_list)
+            _, shorturl_code, created = create_link(longurl, **settings)
+            if created:
+                shortcode_filter.add(shorturl_code)
+            context.update(host=request.host_url, shorturl=shorturl_code)
 
-    db.close()
-    return render_template('index.html', all_urls=urls_list)
+    query = request.args.get('q', '').strip()
+    try:
+        before = int_arg('before')
+    except ValueError:
+        before = None
+    limit = app.config['INDEX_PAGE_SIZE']
+    urls_list = [url_json(row, request.host_url) for row in storage.list_recent(query, before, limit)]
+    next_before = urls_list[-1]['id'] if len(urls_list) == limit else None
+    return render_template('index.html', all_urls=urls_list, q=query, next_before=next_before, **context)
 
 @app.route('/delete/<int:url_id>', methods=['POST'])
 def delete_url(url_id):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('DELETE FROM urls WHERE id = ?', (url_id,))
-    db.commit()
-    db.close()
+    shorturl_code = storage.delete(url_id)
+    if shorturl_code:
+        invalidate_redirect(shorturl_code)
     return redirect('/')
 
+def redirect_sources_due():
+    """Whether a change poll or snapshot refresh is due; both may query the database."""
+    return change_watcher.due() or (snapshot_redirects is not None and snapshot_redirects.due())
+
+def refresh_redirect_sources():
+    """Evict codes changed by other processes and reload the snapshot and its overlay when due."""
+    change_watcher.poll_if_due()
+    if snapshot_redirects is not None:
+        snapshot_redirects.refresh_if_due()
+
+def cached_redirect(shorturl, refresh=True):
+    """Redirect target known without touching the database.
+
+    Returns the ``(id, longurl, status, max_age, expires_at)`` target, False if the code
+    is known not to exist, or None if the database has to be asked. With
+    ``refresh=False`` the caller runs ``refresh_redirect_sources`` itself.
+    """
+    if refresh:
+        refresh_redirect_sources()
+    if snapshot_redirects is not None:
+        cached = snapshot_redirects.lookup(shorturl)
+        if cached is not None:
+            return cached
+        # Codes changed since the build are always read from the database
+        if not app.config['SNAPSHOT_FALLBACK'] and not snapshot_redirects.is_stale(shorturl):
+            return False
+    cached = redirect_cache.get(shorturl)
+    if cached is not None:
+        return cached
+    if app.config['SHORTCODE_FILTER']:
+        shortcode_filter.build_async()
+        if not shortcode_filter.might_contain(shorturl):
+            return False
+    return None
+
+def load_redirect(shorturl):
+    """Look ``shorturl`` up in storage and cache it; returns the target or None."""
+    generation = redirect_cache.generation
+    result = storage.get_by_code(shorturl)
+    if not result:
+        return None
+    cached = tuple(result)
+    redirect_cache.set(shorturl, cached, generation)
+    return cached
+
+def redirect_response(target):
+    url_id, longurl, status, max_age, expires_at = target
+    now = time.time()
+    if expires_at is not None and expires_at <= now:
+        # Until the reaper deletes it; the code is never handed out again
+        return app.response_class("URL has expired", 410)
+    if app.config['CLICK_ANALYTICS']:
+        click_recorder.record(url_id)
+    status = status or app.config['REDIRECT_STATUS']
+    response = redirect(longurl, code=status)
+    if max_age is None:
+        max_age = app.config['REDIRECT_MAX_AGE']
+    # Caches must not outlive the link; without a max-age, browsers keep
+    # permanent redirects indefinitely
+    if expires_at is not None and (max_age is not None or status in (301, 308)):
+        max_age = int(min(expires_at - now, MAX_CACHE_MAX_AGE if max_age is None else max_age))
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
 @app.route('/<shorturl>')
 def redirect_shorturl(shorturl):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('SELECT longurl FROM urls WHERE shorturl = ?', (shorturl,))
-    result = cursor.fetchone()
-    db.close()
-
-    if result:
-        return redirect(result[0])
-    else:
+    target = cached_redirect(shorturl)
+    if target is None:
+        target = load_redirect(shorturl)
+    if not target:
         return "URL does not exist"
+    return redirect_response(target)
 
 @app.route('/api/urls', methods=['POST'])
 def api_create_url():
@@ -80,59 +481,171 @@ def api_create_url():
 
     if not longurl:
         return jsonify({"error": "Missing longurl"}), 400
+    try:
+        settings = link_settings(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, longurl TEXT, shorturl TEXT UNIQUE)')
-    cursor.execute('SELECT id, shorturl FROM urls WHERE longurl = ?', (longurl,))
-    existing = cursor.fetchone()
+    try:
+        new_id, shorturl_code, created = create_link(longurl, **settings)
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "Failed to create short URL due to collision"}), 500
+    if created:
+        shortcode_filter.add(shorturl_code)
 
-    if existing:
-        db.close()
+    if not created:
         return jsonify({
-            "id": existing[0],
+            "id": new_id,
             "longurl": longurl,
-            "shorturl": existing[1],
-            "access_url": f"{request.host_url}{existing[1]}",
+            "shorturl": shorturl_code,
+            "access_url": f"{request.host_url}{shorturl_code}",
             "message": "URL already exists"
         }), 200
 
-    shorturl_code = randomString(cursor)
+    return jsonify({
+        "id": new_id,
+        "longurl": longurl,
+        "shorturl": shorturl_code,
+        "access_url": f"{request.host_url}{shorturl_code}",
+        "expires_at": settings.get('expires_at')
+    }), 201
+
+@app.route('/api/urls/batch', methods=['POST'])
+def api_create_urls_batch():
+    """Shorten a JSON array (or NDJSON stream) of URLs in one transaction.
+
+    Items may be plain strings or ``{"longurl": ...}`` objects, which may
+    also carry the same link settings as ``POST /api/urls``. Results come
+    back in input order, each with its own status.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return jsonify({"error": "Invalid NDJSON"}), 400
+    elif request.is_json:
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get('urls')
+        if not isinstance(items, list):
+            return jsonify({"error": "Request must be a JSON array of URLs"}), 400
+    else:
+        return jsonify({"error": "Request must be JSON"}), 400
+
+    if len(items) > app.config['API_BATCH_MAX_SIZE']:
+        return jsonify({"error": f"Batch too large (max {app.config['API_BATCH_MAX_SIZE']})"}), 413
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        longurl = item.get('longurl') if isinstance(item, dict) else item
+        if not longurl or not isinstance(longurl, str):
+            results[index] = {"index": index, "status": "error", "error": "Missing longurl"}
+            continue
+        try:
+            settings = link_settings(item) if isinstance(item, dict) else {}
+        except ValueError as e:
+            results[index] = {"index": index, "status": "error", "error": str(e)}
+            continue
+        valid.append((index, longurl, settings))
+
     try:
-        cursor.execute('INSERT INTO urls (longurl, shorturl) VALUES (?, ?)', (longurl, shorturl_code))
-        db.commit()
-        new_id = cursor.lastrowid
-        db.close()
-        return jsonify({
-            "id": new_id,
+        stored = storage.create_many([longurl for _, longurl, _ in valid],
+                                     settings=[settings for _, _, settings in valid])
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "Failed to create short URLs due to collision"}), 500
+
+    for (index, longurl, settings), (url_id, shorturl_code, created) in zip(valid, stored):
+        if created:
+            shortcode_filter.add(shorturl_code)
+        results[index] = {
+            "index": index,
+            "status": "created" if created else "exists",
+            "id": url_id,
             "longurl": longurl,
             "shorturl": shorturl_code,
             "access_url": f"{request.host_url}{shorturl_code}"
-        }), 201
-    except sqlite3.IntegrityError:
-        db.close()
-        return jsonify({"error": "Failed to create short URL due to collision"}), 500
+        }
+        if created:
+            results[index]["expires_at"] = settings.get('expires_at')
+    return jsonify({"results": results}), 200
 
 @app.route('/api/urls', methods=['GET'])
 def api_get_urls():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('SELECT id, longurl, shorturl FROM urls')
-    urls_list = [{"id": row[0], "longurl": row[1], "shorturl": row[2], "access_url": f"{request.host_url}{row[2]}"} for row in cursor.fetchall()]
-    db.close()
-    return jsonify(urls_list), 200
+    """List links in id order, one page at a time.
+
+    ``after`` is the last id of the previous page and ``limit`` the page
+    size. The next page is advertised in the ``Link`` and ``X-Next-Cursor``
+    headers. With ``stream=ndjson`` (or ``Accept: application/x-ndjson``)
+    every link after ``after`` is streamed as one JSON object per line.
+    """
+    try:
+        after = int_arg('after', 0)
+        limit = int_arg('limit')
+    except ValueError:
+        return jsonify({"error": "after and limit must be non-negative integers"}), 400
+
+    host_url = request.host_url
+
+    if request.args.get('stream') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        batch_size = app.config['API_STREAM_BATCH_SIZE']
+        urls = storage.iter_urls(after, limit, batch_size)
+
+        def generate():
+            while True:
+                rows = list(itertools.islice(urls, batch_size))
+                if not rows:
+                    return
+                yield ''.join(json.dumps(url_json(row, host_url)) + '\n' for row in rows)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if limit is None:
+        limit = app.config['API_PAGE_SIZE']
+    limit = min(limit, app.config['API_MAX_PAGE_SIZE'])
+    rows = storage.list_page(after, limit)
+    # A page has no usable Last-Modified: deleting one of its links changes
+    # it without touching any remaining row. The ETag covers that.
+    etag = hashlib.blake2b(','.join(link_etag(row) for row in rows).encode(), digest_size=12).hexdigest()
+    response = not_modified(etag)
+    if response is None:
+        response = set_validators(jsonify([url_json(row, host_url) for row in rows]), etag)
+    if limit and len(rows) == limit:
+        next_cursor = rows[-1][0]
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{url_for("api_get_urls", after=next_cursor, limit=limit, _external=True)}>; rel="next"'
+    return response
 
 @app.route('/api/urls/<int:url_id>', methods=['GET'])
 def api_get_url(url_id):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('SELECT id, longurl, shorturl FROM urls WHERE id = ?', (url_id,))
-    row = cursor.fetchone()
-    db.close()
-    if row:
-        return jsonify({"id": row[0], "longurl": row[1], "shorturl": row[2], "access_url": f"{request.host_url}{row[2]}"}), 200
-    else:
+    row = storage.get_by_id(url_id)
+    if not row:
         return jsonify({"error": "URL not found"}), 404
+    etag = link_etag(row)
+    response = not_modified(etag, row[6])
+    if response is None:
+        response = set_validators(jsonify(url_json(row, request.host_url)), etag, row[6])
+    return response
+
+@app.route('/api/urls/<int:url_id>/stats', methods=['GET'])
+def api_get_url_stats(url_id):
+    """Click counts for a link: the all-time total plus per-minute buckets.
+
+    Clicks are written behind the redirect, so the newest second or so may
+    not be counted yet.
+    """
+    try:
+        minutes = min(int_arg('minutes', 60), app.config['CLICK_STATS_MAX_MINUTES'])
+    except ValueError:
+        return jsonify({"error": "minutes must be a non-negative integer"}), 400
+
+    if not storage.get_by_id(url_id):
+        return jsonify({"error": "URL not found"}), 404
+
+    since = (int(time.time()) // 60 - minutes + 1) * 60
+    total, rows = storage.click_stats(url_id, since)
+    buckets = [{"minute": row[0], "count": row[1]} for row in rows]
+    return jsonify({"id": url_id, "total_clicks": total, "minutes": buckets}), 200
 
 @app.route('/api/urls/<int:url_id>', methods=['PUT'])
 def api_update_url(url_id):
@@ -140,39 +653,190 @@ def api_update_url(url_id):
         return jsonify({"error": "Request must be JSON"}), 400
     data = request.get_json()
     new_longurl = data.get('longurl')
+    try:
+        settings = link_settings(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if not new_longurl:
+    if not new_longurl and not settings:
         return jsonify({"error": "Missing longurl"}), 400
 
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('SELECT id FROM urls WHERE id = ?', (url_id,))
-    if not cursor.fetchone():
-        db.close()
+    updated_row = storage.update(url_id, new_longurl or None, **settings)
+    if not updated_row:
         return jsonify({"error": "URL not found"}), 404
+    invalidate_redirect(updated_row[2])
 
-    cursor.execute('UPDATE urls SET longurl = ? WHERE id = ?', (new_longurl, url_id))
-    db.commit()
-
-    cursor.execute('SELECT id, longurl, shorturl FROM urls WHERE id = ?', (url_id,))
-    updated_row = cursor.fetchone()
-    db.close()
-
-    return jsonify({"id": updated_row[0], "longurl": updated_row[1], "shorturl": updated_row[2], "access_url": f"{request.host_url}{updated_row[2]}"}), 200
+    return set_validators(jsonify(url_json(updated_row, request.host_url)), link_etag(updated_row),
+                          updated_row[6]), 200
 
 @app.route('/api/urls/<int:url_id>', methods=['DELETE'])
 def api_delete_url(url_id):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute('SELECT id FROM urls WHERE id = ?', (url_id,))
-    if not cursor.fetchone():
-        db.close()
+    shorturl_code = storage.delete(url_id)
+    if not shorturl_code:
         return jsonify({"error": "URL not found"}), 404
-
-    cursor.execute('DELETE FROM urls WHERE id = ?', (url_id,))
-    db.commit()
-    db.close()
+    invalidate_redirect(shorturl_code)
     return '', 204
 
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    return jsonify(redirect_cache.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return "Metrics are disabled", 404
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/filter/stats', methods=['GET'])
+def api_filter_stats():
+    return jsonify(dict(shortcode_filter.stats(), enabled=app.config['SHORTCODE_FILTER'])), 200
+
+@app.route('/api/snapshot/stats', methods=['GET'])
+def api_snapshot_stats():
+    if snapshot_redirects is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(snapshot_redirects.stats(), enabled=True)), 200
+
+def close_connections():
+    change_watcher.close()
+    storage.close()
+
+def stop_worker():
+    group_writer.stop()
+    link_reaper.stop()
+    click_recorder.stop()
+    close_connections()
+
+@app.cli.command('serve')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=5000, show_default=True)
+@click.option('--workers', default=4, show_default=True, help='Worker processes to fork.')
+def serve_command(host, port, workers):
+    """Serve the app with several pre-forked worker processes."""
+    if app.config['SHORTCODE_FILTER'] and workers > 1:
+        # Each worker's filter only learns the codes that worker creates, so
+        # links made by the others would be reported missing there for good
+        raise click.UsageError('SHORTCODE_FILTER only works with a single worker')
+    if not app.config['CHANGE_POLL_INTERVAL'] and workers > 1:
+        click.echo('Warning: CHANGE_POLL_INTERVAL is 0, so workers will not see each other\'s changes.', err=True)
+    prefork.serve(app, host, port, workers, before_fork=close_connections, on_exit=stop_worker)
+
+@app.cli.command('build-snapshot')
+@click.argument('path', required=False)
+def build_snapshot_command(path):
+    """Compile every link into a redirect snapshot file."""
+    path = path or app.config['REDIRECT_SNAPSHOT']
+    if not path:
+        raise click.UsageError('Pass a path or set REDIRECT_SNAPSHOT')
+    started = time.perf_counter()
+    count = build_snapshot(storage.iter_urls(), path, streams=storage.id_streams)
+    click.echo(f'Wrote {count} links to {path} in {time.perf_counter() - started:.1f}s')
+
+@app.cli.command('reap-expired')
+def reap_expired_command():
+    """Delete expired links now and reclaim their disk space."""
+    deleted = link_reaper.reap()
+    click.echo(f'Deleted {deleted} expired links, reclaimed {link_reaper.vacuumed} pages')
+
+@app.cli.command('vacuum')
+@click.option('--incremental', is_flag=True, help='Switch to incremental auto-vacuum so the reaper can reclaim space.')
+def vacuum_command(incremental):
+    """Rebuild the database files, returning all free space to the filesystem.
+
+    Needs as much free disk as the database takes and blocks writers while
+    it runs.
+    """
+    started = time.perf_counter()
+    storage.vacuum(incremental)
+    click.echo(f'Vacuumed in {time.perf_counter() - started:.1f}s')
+
+@app.cli.command('rehash-urls')
+def rehash_urls_command():
+    """Recompute dedupe hashes after changing URL_NORMALIZATION.
+
+    The oldest link for each normalized URL becomes the one new requests
+    reuse. Writers are blocked while it runs.
+    """
+    started = time.perf_counter()
+    for db_handle in storage.databases():
+        db = db_handle.acquire()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                rehash(db)
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+        finally:
+            db_handle.release(db)
+    click.echo(f'Rehashed links in {time.perf_counter() - started:.1f}s')
+
+@app.cli.command('import-urls')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per batch.')
+@click.option('--resume', is_flag=True, help='Continue after the last completed batch of an earlier run.')
+def import_urls_command(path, fmt, batch_size, resume):
+    """Stream links from a CSV or JSON Lines file into the database.
+
+    CSV files need a header with a longurl column and may have a shorturl
+    column; JSON Lines hold objects with the same keys. Supplied short codes
+    are kept, URLs that are already stored are skipped.
+    """
+    reserved = {rule.rule.split('/')[1] for rule in app.url_map.iter_rules()}
+    def progress(stats, elapsed):
+        click.echo(f'\rimported {stats["rows"]} rows ({stats["created"]} created, {stats["existing"]} existing, '
+                   f'{stats["conflicts"]} code conflicts, {stats["invalid"]} invalid) '
+                   f'{stats["rows"] / elapsed if elapsed else 0:.0f} rows/s', nl=False, err=True)
+
+    try:
+        transfer.import_file(storage, path, fmt, batch_size, resume, progress, reserved)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    click.echo(err=True)
+
+@app.cli.command('export-urls')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows fetched and written at a time.')
+@click.option('--resume', is_flag=True, help='Append to PATH after the last complete row it holds.')
+def export_urls_command(path, fmt, batch_size, resume):
+    """Stream every link to a CSV or JSON Lines file in id order."""
+    def progress(rows, elapsed):
+        click.echo(f'\rexported {rows} rows {rows / elapsed if elapsed else 0:.0f} rows/s', nl=False, err=True)
+
+    try:
+        transfer.export_file(storage, path, fmt, batch_size, resume, progress)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    click.echo(err=True)
+
+def admin_error():
+    """Error response unless the request carries the admin token."""
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        return jsonify({"error": "Admin endpoints are disabled"}), 404
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({"error": "Invalid admin token"}), 401
+    return None
+
+@app.route('/admin/profiles', methods=['GET'])
+def admin_list_profiles():
+    error = admin_error()
+    if error:
+        return error
+    return jsonify(profiler.list()), 200
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def admin_get_profile(name):
+    error = admin_error()
+    if error:
+        return error
+    if not PROFILE_NAME.match(name):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_from_directory(profiler.directory, name, mimetype='application/json', as_attachment=True)
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,231 @@
+"""ASGI entry point for serving many concurrent connections per process.
+
+    uvicorn asgi:application
+
+Redirects whose target is already in the snapshot or the redirect cache are
+answered on the event loop; other redirects look the code up on a bounded
+thread pool. So do the periodic change polls and snapshot overlay refreshes,
+which query SQLite. Every other request runs through the Flask app on the same
+pool, so it behaves exactly as under WSGI. Idle keep-alive connections and
+requests waiting for a thread cost no thread of their own. Requests waiting
+for a thread count towards the app's load shedding thresholds, and
+redirects are shed and rate limited as under WSGI.
+"""
+import asyncio
+import io
+import itertools
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+import metrics
+from app import (app, cached_redirect, client_key, link_reaper, load_redirect, load_shedder, redirect_response,
+                 redirect_sources_due, refresh_redirect_sources, refusal)
+
+NOT_FOUND = "URL does not exist"
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP ``scope`` and its complete body."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class ASGIApp:
+    """Serve a Flask ``flask_app`` over ASGI with at most ``max_workers`` threads."""
+
+    def __init__(self, flask_app, max_workers=None):
+        self.app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers or flask_app.config['ASGI_MAX_WORKERS'],
+                                           thread_name_prefix='asgi')
+        self.urls = flask_app.url_map.bind('localhost')
+        self._refreshing = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            shorturl = self.redirect_code(scope)
+            if shorturl is not None:
+                await self.redirect(shorturl, scope, send)
+            else:
+                await self.wsgi(scope, await self.read_body(receive), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                link_reaper.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                link_reaper.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    def redirect_code(self, scope):
+        """The short code of a plain redirect request, or None.
+
+        Requests that are profiled, or that the URL map sends anywhere else,
+        take the WSGI path.
+        """
+        if scope['method'] != 'GET' or scope.get('root_path'):
+            return None
+        config = self.app.config
+        if config['PROFILE_SAMPLE_RATE']:
+            return None
+        if config['ADMIN_TOKEN']:
+            header = config['PROFILE_HEADER'].lower().encode('latin-1')
+            if any(name == header for name, _ in scope.get('headers', ())):
+                return None
+        try:
+            endpoint, args = self.urls.match(scope['path'], 'GET')
+        except HTTPException:
+            return None
+        return args['shorturl'] if endpoint == 'redirect_shorturl' else None
+
+    async def redirect(self, shorturl, scope, send):
+        started = time.perf_counter()
+        response = self.refusal(scope)
+        if response is None:
+            response = await self.redirect_target(shorturl)
+        if self.app.config['METRICS_ENABLED']:
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - started,
+                                             ('redirect_shorturl', 'GET', str(response.status_code)))
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response.headers.to_wsgi_list()]})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    def refusal(self, scope):
+        """The load shedding or rate limit response for a redirect, as under WSGI, or None."""
+        config = self.app.config
+        if 'redirect_shorturl' not in config['RATE_LIMITS'] and not load_shedder.level():
+            return None
+        header = config['RATE_LIMIT_KEY_HEADER'].lower().encode('latin-1')
+        api_key = next((value.decode('latin-1') for name, value in scope.get('headers', ()) if name == header), None)
+        with self.app.app_context():
+            return refusal('redirect_shorturl', client_key(api_key, (scope.get('client') or ('',))[0]))
+
+    async def redirect_target(self, shorturl):
+        if not self._refreshing and redirect_sources_due():
+            # Requests arriving meanwhile use what is already loaded
+            self._refreshing = True
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.refresh)
+            finally:
+                self._refreshing = False
+        target = cached_redirect(shorturl, refresh=False)
+        if target is None:
+            target = await self.run_queued(self.load, shorturl)
+        return redirect_response(target) if target else self.app.response_class(NOT_FOUND)
+
+    async def run_queued(self, function, *args):
+        """Run ``function`` on the pool, counted as queued until a thread starts it.
+
+        Whichever comes first, the thread starting or this coroutine ending
+        (also when cancelled), takes it off the queue, exactly once.
+        """
+        queued = threading.Lock()
+
+        def run():
+            if queued.acquire(blocking=False):
+                load_shedder.wait(-1)
+            return function(*args)
+
+        load_shedder.wait(1)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        finally:
+            if queued.acquire(blocking=False):
+                load_shedder.wait(-1)
+
+    def refresh(self):
+        with self.app.app_context():
+            refresh_redirect_sources()
+
+    def load(self, shorturl):
+        with self.app.app_context():
+            return load_redirect(shorturl)
+
+    async def wsgi(self, scope, body, send):
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, body)
+        await self.run_queued(self.run_wsgi, environ, send, loop)
+
+    def run_wsgi(self, environ, send, loop):
+        """Run one request through the WSGI app on a pool thread.
+
+        The whole request, including iterating a streamed body, stays on
+        this thread because Flask's contexts are bound to it. Each message
+        waits for the event loop to send it, which applies backpressure.
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]),
+                          [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        body = self.app(environ, start_response)
+        try:
+            # WSGI apps may delay start_response until their first chunk
+            chunks = iter(body)
+            first = next(chunks, b'')
+            emit({'type': 'http.response.start', 'status': started[0], 'headers': started[1]})
+            for chunk in itertools.chain((first,), chunks):
+                if chunk:
+                    emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            emit({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+application = ASGIApp(app)
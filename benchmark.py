@@ -0,0 +1,303 @@
+"""Load-testing and benchmark harness for the URL shortener.
+
+Seeds a scratch database, then drives the redirect, create and list routes
+either in-process through the Flask test client or against a locally
+launched server with concurrent keep-alive clients. Redirect traffic
+follows a Zipf distribution over the seeded links. Results (throughput and
+p50/p95/p99 latency per route) are written as JSON and can be compared with
+a stored baseline:
+
+    python benchmark.py --links 100000 --output results.json
+    python benchmark.py --links 100000 --baseline results.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from migrations import migrate
+from normalize import url_hash
+from shortcodes import SequenceCodeGenerator
+
+ROUTES = ('redirect', 'create', 'list')
+
+
+def seed_database(path, links, batch_size=50000, progress=None):
+    """Create ``path`` holding ``links`` links and return their short codes."""
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    migrate(db)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = OFF')
+    generator = SequenceCodeGenerator()
+    codes = []
+    for start in range(0, links, batch_size):
+        rows = []
+        for value in range(start, min(start + batch_size, links)):
+            longurl = f'https://example.com/{value % 997}/page/{value}'
+            code = generator.encode(value)
+            codes.append(code)
+            rows.append((longurl, code, url_hash(longurl)))
+        db.executemany('INSERT INTO urls (longurl, shorturl, longurl_hash) VALUES (?, ?, ?)', rows)
+        db.commit()
+        if progress:
+            progress(len(codes))
+    db.execute("UPDATE code_sequence SET next_value = ? WHERE name = 'shorturl'", (links,))
+    db.commit()
+    db.close()
+    return codes
+
+
+def zipf_rank(count, s, rng):
+    """Draw a 0-based rank from a bounded Zipf(s) law by inverting its CDF."""
+    u = rng.random()
+    if s == 1:
+        rank = math.exp(u * math.log(count + 1))
+    else:
+        rank = ((count + 1) ** (1 - s) * u + (1 - u)) ** (1 / (1 - s))
+    return min(int(rank) - 1, count - 1)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+class Workload:
+    """Generates (method, path, body) requests for one route."""
+
+    def __init__(self, codes, zipf_s, seed):
+        self.codes = codes
+        self.zipf_s = zipf_s
+        self.seed = seed
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def requests(self, route, worker):
+        rng = random.Random(f'{self.seed}-{route}-{worker}')
+        max_id = len(self.codes)
+        while True:
+            if route == 'redirect':
+                yield 'GET', '/' + self.codes[zipf_rank(len(self.codes), self.zipf_s, rng)], None
+            elif route == 'create':
+                with self._lock:
+                    self._created += 1
+                    number = self._created
+                body = json.dumps({"longurl": f'https://bench.example.org/{self.seed}/{worker}/{number}'})
+                yield 'POST', '/api/urls', body
+            else:
+                yield 'GET', f'/api/urls?limit=100&after={rng.randrange(max_id)}', None
+
+
+def run_workers(workers, make_client, workload, route, count):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_worker = [count // workers + (1 if i < count % workers else 0) for i in range(workers)]
+
+    def worker(index):
+        send = make_client()
+        local = []
+        failures = 0
+        requests = workload.requests(route, index)
+        for _ in range(per_worker[index]):
+            method, path, body = next(requests)
+            started = time.perf_counter()
+            try:
+                status = send(method, path, body)
+            except OSError:
+                status = None
+            local.append((time.perf_counter() - started) * 1000)
+            if status is None or status >= 500:
+                failures += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failures
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def inprocess_client_factory(app):
+    def make_client():
+        client = app.test_client()
+
+        def send(method, path, body):
+            return client.open(path, method=method, data=body, content_type='application/json').status_code
+        return send
+    return make_client
+
+
+def http_client_factory(host, port):
+    def make_client():
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+
+        def send(method, path, body):
+            headers = {'Content-Type': 'application/json'} if body else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        return send
+    return make_client
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch_server(db_path, port):
+    env = dict(os.environ, FLASK_DATABASE=db_path)
+    command = [sys.executable, '-c',
+               f'from app import app; app.run(host="127.0.0.1", port={port}, threaded=True)']
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Benchmark server did not start')
+
+
+def run_inprocess(db_path, workload, args):
+    from app import app, database
+
+    previous = app.config['DATABASE']
+    app.config['DATABASE'] = db_path
+    database.close()
+    try:
+        make_client = inprocess_client_factory(app)
+        return {route: run_workers(args.concurrency, make_client, workload, route, args.requests)
+                for route in args.routes}
+    finally:
+        database.close()
+        app.config['DATABASE'] = previous
+
+
+def run_server(db_path, workload, args):
+    port = free_port()
+    process = launch_server(db_path, port)
+    try:
+        make_client = http_client_factory('127.0.0.1', port)
+        return {route: run_workers(args.concurrency, make_client, workload, route, args.requests)
+                for route in args.routes}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(results, baseline, threshold):
+    """Return human-readable lines and whether any metric regressed."""
+    lines = []
+    regressed = False
+    for mode, routes in results['modes'].items():
+        for route, current in routes.items():
+            previous = baseline.get('modes', {}).get(mode, {}).get(route)
+            if not previous:
+                continue
+            for metric, higher_is_better in (('throughput', True), ('p50_ms', False),
+                                             ('p95_ms', False), ('p99_ms', False)):
+                old, new = previous.get(metric), current.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = change < -threshold if higher_is_better else change > threshold
+                regressed = regressed or worse
+                lines.append(f'{mode:<9} {route:<9} {metric:<11} {old:>10.2f} -> {new:>10.2f} '
+                             f'({change:+.1%}){"  REGRESSION" if worse else ""}')
+    return lines, regressed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--links', type=int, default=100000, help='links to seed (default: 100000)')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per route (default: 5000)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients (default: 8)')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of redirect traffic (default: 1.1)')
+    parser.add_argument('--mode', choices=('inprocess', 'server', 'both'), default='both')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+    parser.add_argument('--database', help='scratch database path (default: a temporary file)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against results stored in this file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change reported as a regression (default: 0.10)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scratch = tempfile.TemporaryDirectory()
+    db_path = args.database or os.path.join(scratch.name, 'bench.db')
+
+    started = time.perf_counter()
+    codes = seed_database(db_path, args.links,
+                          progress=lambda n: print(f'\rseeded {n}/{args.links} links', end='', file=sys.stderr))
+    print(f'\nseeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    workload = Workload(codes, args.zipf, args.seed)
+    results = {
+        "config": {key: getattr(args, key) for key in ('links', 'requests', 'concurrency', 'zipf', 'seed')},
+        "modes": {},
+    }
+    modes = ('inprocess', 'server') if args.mode == 'both' else (args.mode,)
+    for mode in modes:
+        runner = run_inprocess if mode == 'inprocess' else run_server
+        results['modes'][mode] = runner(db_path, workload, args)
+        for route, summary in results['modes'][mode].items():
+            print(f'{mode:<9} {route:<9} {summary["throughput"]:>9.1f} req/s  p50 {summary["p50_ms"]:.2f}ms  '
+                  f'p95 {summary["p95_ms"]:.2f}ms  p99 {summary["p99_ms"]:.2f}ms  errors {summary["errors"]}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            lines, regressed = compare(results, json.load(baseline_file), args.threshold)
+        print('\n'.join(lines))
+        exit_code = 1 if regressed else 0
+    scratch.cleanup()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for ``capacity`` items at ``error_rate``."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+class ScalableBloomFilter:
+    """Bloom filter that adds a larger layer whenever the current one is full.
+
+    Each new layer doubles the capacity and halves the error rate, which
+    keeps the overall false-positive rate below ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.error_rate = error_rate
+        self.layers = [BloomFilter(capacity, error_rate / 2)]
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            layer = self.layers[-1]
+            if layer.count >= layer.capacity:
+                layer = BloomFilter(layer.capacity * 2, layer.error_rate / 2)
+                self.layers.append(layer)
+            layer.add(key)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def stats(self):
+        return {
+            "items": sum(layer.count for layer in self.layers),
+            "capacity": sum(layer.capacity for layer in self.layers),
+            "layers": len(self.layers),
+            "error_rate": self.error_rate,
+            "memory_bytes": sum(layer.memory_bytes for layer in self.layers),
+        }
+
+
+class ShortCodeFilter:
+    """Negative-lookup filter over every short code in ``storage``.
+
+    ``build`` loads the codes in a background thread. Until it finishes,
+    every code is reported as possibly present, so lookups fall through to
+    the database. Codes added while the build runs land in the new filter.
+    """
+
+    def __init__(self, storage, error_rate=0.001, min_capacity=10000):
+        self.storage = storage
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.filter = None
+        self.ready = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._building = False
+
+    def might_contain(self, code):
+        if not self.ready:
+            return True
+        if code in self.filter:
+            return True
+        self.rejected += 1
+        return False
+
+    def add(self, code):
+        if self.filter is not None:
+            self.filter.add(code)
+
+    def build_async(self):
+        with self._lock:
+            if self._building or self.ready:
+                return
+            self._building = True
+        threading.Thread(target=self._build, name='shortcode-filter', daemon=True).start()
+
+    def _build(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception('Failed to build the short code filter')
+        finally:
+            self._building = False
+
+    def build(self):
+        count = self.storage.count()
+        self.filter = ScalableBloomFilter(max(count * 2, self.min_capacity), self.error_rate)
+        for code in self.storage.iter_codes():
+            self.filter.add(code)
+        self.ready = True
+
+    def reset(self):
+        self.filter = None
+        self.ready = False
+        self.rejected = 0
+
+    def stats(self):
+        stats = {"ready": self.ready, "rejected": self.rejected}
+        if self.filter is not None:
+            stats.update(self.filter.stats())
+        return stats
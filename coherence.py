@@ -0,0 +1,124 @@
+"""Cross-process redirect cache invalidation through SQLite.
+
+Triggers append the code of every updated or deleted link to the
+``url_changes`` table. Each process reads ``PRAGMA data_version`` on one
+dedicated connection per database; it only changes when another connection
+has committed, so an idle database costs one pragma per poll. When it does
+change, the log entries past the last one seen are read and only those
+codes are evicted.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Watched:
+    def __init__(self, db, now):
+        self.db = db
+        self.version = db.execute('PRAGMA data_version').fetchone()[0]
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'url_changes'").fetchone()
+        self.last_id = row[0] if row else 0
+        self.pruned = now
+
+
+class ChangeWatcher:
+    """Passes codes changed by other processes to ``invalidate``.
+
+    ``poll_if_due`` is cheap enough for the redirect path and polls at most
+    every ``interval`` seconds; ``0`` disables watching. If entries this
+    process had not read yet were already pruned, ``reset`` is called to
+    drop everything instead. Entries older than ``retention`` seconds are
+    pruned. Connections are reopened after a fork.
+    """
+
+    def __init__(self, databases, invalidate, reset, interval=1.0, retention=86400):
+        self.databases = databases
+        self.invalidate = invalidate
+        self.reset = reset
+        self.interval = interval
+        self.retention = retention
+        self.invalidated = 0
+        self.resets = 0
+        self._watched = {}
+        self._pid = os.getpid()
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def due(self, now=None):
+        if not self.interval or not self.databases:
+            return False
+        return (time.monotonic() if now is None else now) >= self._next_poll
+
+    def poll_if_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.due(now):
+            self.poll(now)
+
+    def poll(self, now=None):
+        # Whoever holds the lock is already polling; requests never wait
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic() if now is None else now
+            self._next_poll = now + self.interval
+            if self._pid != os.getpid():
+                # The parent's connections must not be used after a fork
+                self._pid = os.getpid()
+                self._watched = {}
+            for index, database in enumerate(self.databases):
+                try:
+                    self._poll(index, database, now)
+                except sqlite3.Error:
+                    logger.exception('Failed to read the link change log')
+                    self._forget(index)
+        finally:
+            self._lock.release()
+
+    def _poll(self, index, database, now):
+        watched = self._watched.get(index)
+        if watched is None:
+            self._watched[index] = _Watched(database.acquire(), now)
+            return
+        db = watched.db
+        version = db.execute('PRAGMA data_version').fetchone()[0]
+        if version != watched.version:
+            watched.version = version
+            rows = db.execute('SELECT id, shorturl FROM url_changes WHERE id > ? ORDER BY id',
+                              (watched.last_id,)).fetchall()
+            if rows and rows[0][0] != watched.last_id + 1:
+                logger.warning('Link changes were pruned before this process read them; clearing caches')
+                self.resets += 1
+                self.reset()
+            else:
+                for _, code in rows:
+                    self.invalidate(code)
+                self.invalidated += len(rows)
+            if rows:
+                watched.last_id = rows[-1][0]
+        if now - watched.pruned >= min(self.retention, 3600):
+            watched.pruned = now
+            db.execute('DELETE FROM url_changes WHERE changed_at < ?', (int(time.time()) - self.retention,))
+            db.commit()
+
+    def _forget(self, index):
+        # Dedicated connections are closed rather than returned to a pool
+        watched = self._watched.pop(index, None)
+        if watched is not None:
+            try:
+                watched.db.close()
+            except sqlite3.Error:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                for index in list(self._watched):
+                    self._forget(index)
+            self._watched = {}
+
+    def stats(self):
+        return {"databases": len(self._watched), "invalidated": self.invalidated, "resets": self.resets}
@@ -0,0 +1,174 @@
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import g
+
+from metrics import CONNECTION_OPEN, current_trace
+from migrations import migrate, register_functions
+
+PRAGMAS = (
+    ('journal_mode', 'DB_JOURNAL_MODE'),
+    ('synchronous', 'DB_SYNCHRONOUS'),
+    ('cache_size', 'DB_CACHE_SIZE'),
+    ('mmap_size', 'DB_MMAP_SIZE'),
+    ('busy_timeout', 'DB_BUSY_TIMEOUT'),
+)
+
+
+class ConnectionPool:
+    """Keeps up to ``size`` idle SQLite connections around for reuse.
+
+    Connections are opened on demand when the pool is empty, so the pool
+    never blocks; ``size`` only bounds how many are kept open between
+    requests.
+    """
+
+    def __init__(self, path, size=8, pragmas=(), readonly=False, setup=None, factory=sqlite3.Connection):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self.readonly = readonly
+        self.setup = setup
+        self.factory = factory
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def _connect(self):
+        started = time.perf_counter()
+        if self.readonly:
+            db = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                                 factory=self.factory)
+        else:
+            db = sqlite3.connect(self.path, check_same_thread=False, factory=self.factory)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            if value is None or (self.readonly and name == 'journal_mode'):
+                continue
+            db.execute(f'PRAGMA {name} = {value}')
+        if self.setup is not None:
+            self.setup(db)
+        CONNECTION_OPEN.observe(time.perf_counter() - started, ('read' if self.readonly else 'write',))
+        trace = current_trace()
+        if trace is not None:
+            trace.connections_opened += 1
+        return db
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if self._closed:
+            db.close()
+            return
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Database:
+    """Per-app connection management.
+
+    A request borrows at most one connection from each pool and gives it
+    back when the app context is torn down. Pools are built lazily from
+    ``app.config`` so settings can still be changed after import, and the
+    schema is migrated once when they are first built. ``path`` overrides
+    the ``DATABASE`` setting; each instance on an app needs its own ``name``.
+    """
+
+    def __init__(self, app=None, connection_factory=sqlite3.Connection, path=None, name='db'):
+        self.app = None
+        self.connection_factory = connection_factory
+        self.path = path
+        self.name = name
+        self._pools = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions.setdefault('database', self)
+        app.teardown_appcontext(self.teardown)
+
+    def pools(self):
+        pools = self._pools
+        if pools is None:
+            with self._lock:
+                if self._pools is None:
+                    self._pools = self._create_pools()
+                pools = self._pools
+        return pools
+
+    def _create_pools(self):
+        config = self.app.config
+        path = self.path or config['DATABASE']
+        pragmas = [(name, config.get(key)) for name, key in PRAGMAS]
+        writer = ConnectionPool(path, config['DB_POOL_SIZE'], pragmas, setup=register_functions,
+                                factory=self.connection_factory)
+        db = writer.acquire()
+        try:
+            migrate(db)
+        finally:
+            writer.release(db)
+        reader = None
+        if config['DB_READ_POOL_SIZE'] and path != ':memory:':
+            reader = ConnectionPool(path, config['DB_READ_POOL_SIZE'], pragmas, readonly=True,
+                                    setup=register_functions, factory=self.connection_factory)
+        return writer, reader
+
+    def connection(self, readonly=False):
+        writer, reader = self.pools()
+        if readonly and reader is not None:
+            key, pool = f'_{self.name}_read', reader
+        else:
+            key, pool = f'_{self.name}', writer
+        db = g.get(key)
+        if db is None:
+            db = pool.acquire()
+            setattr(g, key, db)
+            trace = current_trace()
+            if trace is not None:
+                trace.connections_borrowed += 1
+        return db
+
+    def acquire(self):
+        """Borrow a read/write connection outside of a request."""
+        return self.pools()[0].acquire()
+
+    def release(self, db):
+        self.pools()[0].release(db)
+
+    def teardown(self, exc=None):
+        writer, reader = self._pools or (None, None)
+        for key, pool in ((f'_{self.name}', writer), (f'_{self.name}_read', reader)):
+            db = g.pop(key, None)
+            if db is None:
+                continue
+            if pool is None:
+                db.close()
+            else:
+                pool.release(db)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, None
+        if pools is not None:
+            for pool in pools:
+                if pool is not None:
+                    pool.close()
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LinkReaper:
+    """Background deletion of expired links.
+
+    Every ``interval`` seconds expired links are deleted ``batch_size`` at a
+    time, one short transaction per batch found through the expiry index,
+    with a ``pause`` between batches so redirects and creates get the write
+    lock in between. The deleted codes are passed to ``invalidate``. Each run
+    ends with an incremental vacuum of at most ``vacuum_pages`` pages, which
+    hands the freed space back to the filesystem; ``0`` skips it. An
+    ``interval`` of ``0`` disables the thread.
+    """
+
+    def __init__(self, storage, invalidate=None, interval=60.0, batch_size=500, vacuum_pages=1000, pause=0.05):
+        self.storage = storage
+        self.invalidate = invalidate
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.reaped = 0
+        self.vacuumed = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='link-reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                logger.exception('Failed to delete expired links')
+
+    def reap(self, now=None):
+        """Delete every link expired by ``now``; returns how many were deleted."""
+        now = int(time.time()) if now is None else now
+        deleted = 0
+        while True:
+            codes = self.storage.delete_expired(now, self.batch_size)
+            deleted += len(codes)
+            if self.invalidate is not None:
+                for code in codes:
+                    self.invalidate(code)
+            if len(codes) < self.batch_size or self._stopped.wait(self.pause):
+                break
+        self.reaped += deleted
+        if self.vacuum_pages:
+            self.vacuumed += self.storage.incremental_vacuum(self.vacuum_pages)
+        return deleted
+
+    def stats(self):
+        return {"reaped": self.reaped, "vacuumed_pages": self.vacuumed}
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from normalize import url_hash
+
+
+class _Request:
+    def __init__(self, longurl, settings):
+        self.longurl = longurl
+        self.settings = settings
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter:
+    """Creates links for concurrent requests in shared transactions.
+
+    ``create`` queues a URL and blocks until a background thread has stored
+    it together with every other URL that arrived within ``window`` seconds
+    of the first one, or until ``max_batch`` URLs are waiting. A batch is
+    handed to ``create_many(longurls, hashes, settings)`` and costs one
+    commit, so a burst of creates is bound by CPU rather than by how fast
+    the disk syncs. Requests for the same URL in one batch share its code;
+    only the first of them counts as created.
+    """
+
+    def __init__(self, create_many, window=0.002, max_batch=256, timeout=30.0):
+        self.create_many = create_many
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.batches = 0
+        self.requests = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def create(self, longurl, **settings):
+        """``(id, shorturl, created)`` once the batch holding ``longurl`` is committed."""
+        if self._thread is None:
+            self.start()
+        longurl_hash = url_hash(longurl)
+        with self._condition:
+            request = self._pending.get(longurl_hash)
+            first = request is None
+            if first:
+                request = self._pending[longurl_hash] = _Request(longurl, settings)
+                if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                    self._condition.notify()
+            else:
+                self.coalesced += 1
+            self.requests += 1
+        if not request.done.wait(self.timeout):
+            raise TimeoutError('Timed out waiting for the link to be stored')
+        if request.error is not None:
+            raise request.error
+        url_id, shorturl, created = request.result
+        return url_id, shorturl, created and first
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Store whatever is still queued and stop the writer thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, {}
+            self._commit(batch)
+
+    def _commit(self, batch):
+        requests = list(batch.values())
+        try:
+            results = self.create_many([request.longurl for request in requests], list(batch),
+                                       [request.settings for request in requests])
+        except BaseException as error:
+            for request in requests:
+                request.error = error
+                request.done.set()
+            if not isinstance(error, Exception):
+                raise
+            return
+        self.batches += 1
+        for request, result in zip(requests, results):
+            request.result = result
+            request.done.set()
+
+    def stats(self):
+        with self._condition:
+            return {"batches": self.batches, "requests": self.requests, "coalesced": self.coalesced,
+                    "pending": len(self._pending)}
@@ -0,0 +1,264 @@
+"""In-process metrics served in the Prometheus text exposition format.
+
+Recording only touches a small dict under a lock; all formatting happens
+when ``/metrics`` is scraped.
+"""
+import bisect
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in values]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, labels=()):
+        entry = self._values.get(labels)
+        return entry[2] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        lines = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = (('le', _format_value(bound)),)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class GaugeCallback:
+    """Gauge whose values are read from ``callback`` at scrape time.
+
+    ``callback`` returns a mapping of label tuples to values.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, callback, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        registry.register(self)
+
+    def samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in self.callback().items()]
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request latency by route.',
+                             ('endpoint', 'method', 'status'))
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'SQL statement execution time.', ('statement',))
+QUERY_ROWS = Counter('db_query_rows_total', 'Rows returned or changed by SQL statements.', ('statement',))
+CONNECTION_OPEN = Histogram('db_connection_open_seconds', 'Time to open and configure a SQLite connection.',
+                            ('mode',))
+SHORTCODE_RETRIES = Counter('shortcode_retries_total',
+                            'Short code candidates rejected because the code was already taken.', ('generator',))
+SHORTCODE_BLOCKS = Counter('shortcode_blocks_reserved_total', 'Id blocks reserved from the code sequence.')
+REQUESTS_REFUSED = Counter('http_requests_refused_total', 'Requests refused by rate limits or load shedding.',
+                           ('endpoint', 'reason'))
+
+_local = threading.local()
+
+
+class QueryTrace:
+    """Collects every statement run by the current thread while active."""
+
+    def __init__(self):
+        self.queries = []
+        self.connections_opened = 0
+        self.connections_borrowed = 0
+
+    def __enter__(self):
+        _local.trace = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.trace = None
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+_WHITESPACE = re.compile(r'\s+')
+_statement_labels = {}
+
+
+def statement_label(sql):
+    """Collapse whitespace and ``?`` lists so each statement is one series."""
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = _PLACEHOLDER_LIST.sub('?, ...', _WHITESPACE.sub(' ', sql).strip())[:200]
+        if len(_statement_labels) < 1000:
+            _statement_labels[sql] = label
+    return label
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records statement timings and row counts.
+
+    With ``observe`` off only statements run under a ``QueryTrace`` are
+    recorded, and nothing reaches the Prometheus series.
+    """
+
+    observe = True
+    _statement = None
+    _traced = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def _record(self, sql, elapsed):
+        trace = getattr(_local, 'trace', None)
+        self._traced = None
+        if not self.observe and trace is None:
+            self._statement = None
+            return
+        self._statement = statement_label(sql)
+        rows = max(self.rowcount, 0)
+        if self.observe:
+            QUERY_DURATION.observe(elapsed, (self._statement,))
+            if rows:
+                QUERY_ROWS.inc((self._statement,), rows)
+        if trace is not None:
+            self._traced = {"sql": self._statement, "seconds": elapsed, "rows": rows}
+            trace.queries.append(self._traced)
+
+    def _count(self, rows):
+        if rows and self._statement is not None:
+            if self.observe:
+                QUERY_ROWS.inc((self._statement,), rows)
+            if self._traced is not None:
+                self._traced["rows"] += rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count(len(rows))
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute does not go through cursor(), so both shortcuts
+    # are routed explicitly.
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
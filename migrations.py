@@ -0,0 +1,283 @@
+import sqlite3
+
+from normalize import url_hash, url_origin
+
+# The full long URL of a row in ``urls``: links with an interned host keep
+# only the part after it in ``longurl``
+LONGURL = "coalesce((SELECT origin FROM hosts WHERE hosts.id = {row}.host_id), '') || {row}.longurl"
+
+
+# Fills in the dedupe hash for app code that inserts without one. It calls a
+# Python function, so it is a TEMP trigger created on each app connection:
+# other programs can still insert, leaving rows without a hash undeduplicated.
+HASH_TRIGGER = f'''
+    CREATE TEMP TRIGGER IF NOT EXISTS urls_longurl_hash_insert AFTER INSERT ON main.urls
+    WHEN NEW.longurl_hash IS NULL
+    BEGIN
+        UPDATE OR IGNORE urls SET longurl_hash = url_hash({LONGURL.format(row='NEW')}) WHERE id = NEW.id;
+    END
+'''
+
+
+def register_functions(db):
+    """Register the SQL functions the migrations use, and the hash trigger."""
+    db.create_function('url_hash', 1, url_hash, deterministic=True)
+    db.create_function('url_origin', 1, url_origin, deterministic=True)
+    # Only on the current schema; migrate calls this again after upgrading
+    if db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+        db.execute(HASH_TRIGGER)
+
+
+def _create_urls(db):
+    db.execute('CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, longurl TEXT, shorturl TEXT UNIQUE)')
+
+
+def _add_longurl_hash(db):
+    # Rows are hashed in id order and UPDATE OR IGNORE leaves pre-existing
+    # duplicates with a NULL hash, so the oldest row stays the dedupe target
+    # and nothing is deleted. The trigger fills in the hash for app code that
+    # inserts without one.
+    db.execute('ALTER TABLE urls ADD COLUMN longurl_hash BLOB')
+    db.execute('CREATE UNIQUE INDEX urls_longurl_hash ON urls (longurl_hash)')
+    db.execute('UPDATE OR IGNORE urls SET longurl_hash = url_hash(longurl)')
+    db.execute('''
+        CREATE TRIGGER urls_longurl_hash_insert AFTER INSERT ON urls
+        WHEN NEW.longurl_hash IS NULL
+        BEGIN
+            UPDATE OR IGNORE urls SET longurl_hash = url_hash(NEW.longurl) WHERE id = NEW.id;
+        END
+    ''')
+
+
+def _create_code_sequence(db):
+    db.execute('CREATE TABLE code_sequence (name TEXT PRIMARY KEY, next_value INTEGER NOT NULL)')
+    db.execute("INSERT INTO code_sequence (name, next_value) VALUES ('shorturl', 0)")
+
+
+SEARCH_INSERT_TRIGGER = f'''
+    CREATE TRIGGER urls_search_insert AFTER INSERT ON urls BEGIN
+        INSERT INTO urls_search (rowid, longurl, shorturl)
+        VALUES (NEW.id, {LONGURL.format(row='NEW')}, NEW.shorturl);
+    END
+'''
+
+
+def _create_search_index(db):
+    # Trigram FTS5 gives indexed substring search over both columns. Builds
+    # without FTS5 (or older than SQLite 3.34) skip it and fall back to LIKE.
+    try:
+        db.execute('''
+            CREATE VIRTUAL TABLE urls_search USING fts5(
+                longurl, shorturl, content='urls', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return
+    for statement in (
+        '''CREATE TRIGGER urls_search_insert AFTER INSERT ON urls BEGIN
+               INSERT INTO urls_search (rowid, longurl, shorturl) VALUES (NEW.id, NEW.longurl, NEW.shorturl);
+           END''',
+        '''CREATE TRIGGER urls_search_delete AFTER DELETE ON urls BEGIN
+               INSERT INTO urls_search (urls_search, rowid, longurl, shorturl)
+               VALUES ('delete', OLD.id, OLD.longurl, OLD.shorturl);
+           END''',
+        '''CREATE TRIGGER urls_search_update AFTER UPDATE OF longurl, shorturl ON urls BEGIN
+               INSERT INTO urls_search (urls_search, rowid, longurl, shorturl)
+               VALUES ('delete', OLD.id, OLD.longurl, OLD.shorturl);
+               INSERT INTO urls_search (rowid, longurl, shorturl) VALUES (NEW.id, NEW.longurl, NEW.shorturl);
+           END''',
+    ):
+        db.execute(statement)
+    db.execute("INSERT INTO urls_search (urls_search) VALUES ('rebuild')")
+
+
+def _create_clicks(db):
+    db.execute('''
+        CREATE TABLE clicks (
+            url_id INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (url_id, minute)
+        ) WITHOUT ROWID
+    ''')
+    db.execute('''
+        CREATE TRIGGER urls_clicks_delete AFTER DELETE ON urls BEGIN
+            DELETE FROM clicks WHERE url_id = OLD.id;
+        END
+    ''')
+
+
+def _add_link_settings(db):
+    # NULL settings follow the app-wide REDIRECT_STATUS and REDIRECT_MAX_AGE.
+    # version and updated_at back the API's ETag and Last-Modified headers;
+    # links created before this migration have no modification time.
+    for column in ('redirect_status INTEGER', 'cache_max_age INTEGER',
+                   'version INTEGER NOT NULL DEFAULT 1', 'updated_at INTEGER'):
+        db.execute(f'ALTER TABLE urls ADD COLUMN {column}')
+
+
+def _create_change_log(db):
+    # Codes of updated and deleted links, read by every worker process to
+    # evict just those codes from its caches. AUTOINCREMENT keeps ids
+    # increasing after old entries are pruned.
+    db.execute('''
+        CREATE TABLE url_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shorturl TEXT NOT NULL,
+            changed_at INTEGER NOT NULL
+        )
+    ''')
+    db.execute('''
+        CREATE TRIGGER urls_changes_update
+        AFTER UPDATE OF longurl, shorturl, redirect_status, cache_max_age ON urls BEGIN
+            INSERT INTO url_changes (shorturl, changed_at)
+            VALUES (OLD.shorturl, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER urls_changes_delete AFTER DELETE ON urls BEGIN
+            INSERT INTO url_changes (shorturl, changed_at)
+            VALUES (OLD.shorturl, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+
+
+def _add_expiry(db):
+    # The partial index only holds expiring links, so the reaper finds the
+    # next batch without scanning links that never expire.
+    db.execute('ALTER TABLE urls ADD COLUMN expires_at INTEGER')
+    db.execute('CREATE INDEX urls_expires_at ON urls (expires_at) WHERE expires_at IS NOT NULL')
+    db.execute('DROP TRIGGER urls_changes_update')
+    db.execute('''
+        CREATE TRIGGER urls_changes_update
+        AFTER UPDATE OF longurl, shorturl, redirect_status, cache_max_age, expires_at ON urls BEGIN
+            INSERT INTO url_changes (shorturl, changed_at)
+            VALUES (OLD.shorturl, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+
+
+def _intern_hosts(db):
+    # Links to the same few hosts repeat their scheme and host millions of
+    # times; hosts stores each once and longurl keeps the rest. Rows with a
+    # NULL host_id, including any inserted by older code, hold the full URL.
+    db.execute('CREATE TABLE hosts (id INTEGER PRIMARY KEY, origin TEXT NOT NULL UNIQUE)')
+    db.execute('ALTER TABLE urls ADD COLUMN host_id INTEGER')
+    db.execute(f'CREATE VIEW urls_full (id, longurl, shorturl) AS '
+               f'SELECT id, {LONGURL.format(row="urls")}, shorturl FROM urls')
+
+    # Moving every URL must not log it as changed or touch the search index
+    search = has_search_index(db)
+    db.execute('DROP TRIGGER urls_changes_update')
+    if search:
+        for name in ('urls_search_insert', 'urls_search_delete', 'urls_search_update'):
+            db.execute(f'DROP TRIGGER {name}')
+        db.execute('DROP TABLE urls_search')
+    db.execute('INSERT OR IGNORE INTO hosts (origin) '
+               'SELECT DISTINCT url_origin(longurl) FROM urls WHERE url_origin(longurl) IS NOT NULL')
+    db.execute('UPDATE urls SET host_id = (SELECT id FROM hosts WHERE origin = url_origin(urls.longurl)), '
+               'longurl = substr(longurl, length(url_origin(longurl)) + 1) '
+               'WHERE host_id IS NULL AND url_origin(longurl) IS NOT NULL')
+
+    db.execute('''
+        CREATE TRIGGER urls_changes_update
+        AFTER UPDATE OF longurl, host_id, shorturl, redirect_status, cache_max_age, expires_at ON urls BEGIN
+            INSERT INTO url_changes (shorturl, changed_at)
+            VALUES (OLD.shorturl, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+    db.execute('DROP TRIGGER urls_longurl_hash_insert')
+    db.execute(f'''
+        CREATE TRIGGER urls_longurl_hash_insert AFTER INSERT ON urls
+        WHEN NEW.longurl_hash IS NULL
+        BEGIN
+            UPDATE OR IGNORE urls SET longurl_hash = url_hash({LONGURL.format(row='NEW')}) WHERE id = NEW.id;
+        END
+    ''')
+    if search:
+        # Indexed from the view so searches still match the host
+        db.execute('''
+            CREATE VIRTUAL TABLE urls_search USING fts5(
+                longurl, shorturl, content='urls_full', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+        for statement in (
+            SEARCH_INSERT_TRIGGER,
+            f'''CREATE TRIGGER urls_search_delete AFTER DELETE ON urls BEGIN
+                   INSERT INTO urls_search (urls_search, rowid, longurl, shorturl)
+                   VALUES ('delete', OLD.id, {LONGURL.format(row='OLD')}, OLD.shorturl);
+               END''',
+            f'''CREATE TRIGGER urls_search_update AFTER UPDATE OF longurl, host_id, shorturl ON urls BEGIN
+                   INSERT INTO urls_search (urls_search, rowid, longurl, shorturl)
+                   VALUES ('delete', OLD.id, {LONGURL.format(row='OLD')}, OLD.shorturl);
+                   INSERT INTO urls_search (rowid, longurl, shorturl)
+                   VALUES (NEW.id, {LONGURL.format(row='NEW')}, NEW.shorturl);
+               END''',
+        ):
+            db.execute(statement)
+        db.execute("INSERT INTO urls_search (urls_search) VALUES ('rebuild')")
+    # The default normalization now also drops default ports
+    rehash(db)
+
+
+def _drop_hash_trigger(db):
+    # SQLite compiles every trigger on a table to run an INSERT, so a stored
+    # trigger calling url_hash broke all inserts from other programs. Its
+    # replacement is HASH_TRIGGER.
+    db.execute('DROP TRIGGER main.urls_longurl_hash_insert')
+
+
+MIGRATIONS = [
+    (1, _create_urls),
+    (2, _add_longurl_hash),
+    (3, _create_code_sequence),
+    (4, _create_search_index),
+    (5, _create_clicks),
+    (6, _add_link_settings),
+    (7, _create_change_log),
+    (8, _add_expiry),
+    (9, _intern_hosts),
+    (10, _drop_hash_trigger),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def has_search_index(db):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name = 'urls_search'").fetchone() is not None
+
+
+def rehash(db):
+    """Recompute every dedupe hash with the configured normalization.
+
+    Rows are hashed in id order, so the oldest link for a URL stays the
+    dedupe target and newer duplicates are left with a NULL hash. Runs in
+    the caller's transaction.
+    """
+    db.execute('UPDATE urls SET longurl_hash = NULL')
+    db.execute(f"UPDATE OR IGNORE urls SET longurl_hash = url_hash({LONGURL.format(row='urls')})")
+
+
+def migrate(db):
+    """Bring the schema up to date. Safe to call from several processes."""
+    register_functions(db)
+    if db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+    if db.execute('SELECT count(*) FROM sqlite_master').fetchone()[0] == 0:
+        # Only takes effect before the first table is created, and in WAL
+        # mode through a VACUUM, which is instant on an empty file. Existing
+        # databases need `flask --app app vacuum --incremental` once.
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for target, step in MIGRATIONS:
+            if target > version:
+                step(db)
+                db.execute(f'PRAGMA user_version = {target}')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    register_functions(db)
@@ -0,0 +1,119 @@
+import hashlib
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+# Query parameters that only identify the campaign or click, never the page
+TRACKING_PARAMS = frozenset(('fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'igshid',
+                             'mc_cid', 'mc_eid', '_ga', '_gl'))
+ORIGIN = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*')
+
+
+def _lowercase(parts):
+    userinfo, at, hostport = parts.netloc.rpartition('@')
+    return parts._replace(scheme=parts.scheme.lower(), netloc=f'{userinfo}{at}{hostport.lower()}')
+
+
+def _default_port(parts):
+    host, colon, port = parts.netloc.rpartition(':')
+    if colon and port == DEFAULT_PORTS.get(parts.scheme.lower()):
+        return parts._replace(netloc=host)
+    return parts
+
+
+def _empty_path(parts):
+    return parts if parts.path else parts._replace(path='/')
+
+
+def _trailing_slash(parts):
+    return parts._replace(path=parts.path.rstrip('/') or '/')
+
+
+def _query_key(pair):
+    return pair.partition('=')[0].lower()
+
+
+def _tracking_params(parts):
+    pairs = [pair for pair in parts.query.split('&')
+             if pair and not _query_key(pair).startswith('utm_') and _query_key(pair) not in TRACKING_PARAMS]
+    return parts._replace(query='&'.join(pairs))
+
+
+def _sort_query(parts):
+    return parts._replace(query='&'.join(sorted(pair for pair in parts.query.split('&') if pair)))
+
+
+def _fragment(parts):
+    return parts._replace(fragment='')
+
+
+# Steps in the order they run. The first three never change which
+# resource a URL points to; the others usually hold but not for every site.
+STEPS = {
+    'lowercase': _lowercase,
+    'default_port': _default_port,
+    'empty_path': _empty_path,
+    'trailing_slash': _trailing_slash,
+    'tracking_params': _tracking_params,
+    'sort_query': _sort_query,
+    'fragment': _fragment,
+}
+DEFAULT_STEPS = ('lowercase', 'default_port', 'empty_path')
+
+_pipeline = [STEPS[name] for name in DEFAULT_STEPS]
+
+
+def configure(steps):
+    """Choose the normalization steps by name; raises ValueError for unknown ones.
+
+    ``steps`` may be a list or a comma-separated string. Stored hashes only
+    follow the new steps after ``flask --app app rehash-urls``.
+    """
+    if isinstance(steps, str):
+        steps = [name.strip() for name in steps.split(',') if name.strip()]
+    unknown = [name for name in steps if name not in STEPS]
+    if unknown:
+        raise ValueError(f'Unknown URL normalization steps: {", ".join(unknown)}')
+    _pipeline[:] = [step for name, step in STEPS.items() if name in steps]
+
+
+def normalize_url(url):
+    """Return the canonical form of ``url`` used for deduplication.
+
+    Applies the configured steps to URLs with a host; by default scheme
+    and host are lowercased, default ports dropped and an empty path
+    becomes ``/``. The stored URL is never changed.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    if not parts.netloc:
+        return url
+    for step in _pipeline:
+        parts = step(parts)
+    return urlunsplit(parts)
+
+
+def url_hash(url):
+    """Fixed-width (16 byte) digest of the normalized URL."""
+    if url is None:
+        return None
+    return hashlib.blake2b(normalize_url(url).encode('utf-8'), digest_size=16).digest()
+
+
+def split_origin(url):
+    """Split ``url`` into its ``scheme://host`` prefix and the rest.
+
+    The parts concatenate back to ``url`` exactly. URLs without an
+    authority give ``(None, url)``.
+    """
+    match = ORIGIN.match(url)
+    if match is None:
+        return None, url
+    return match.group(), url[match.end():]
+
+
+def url_origin(url):
+    return None if url is None else split_origin(url)[0]
@@ -0,0 +1,101 @@
+"""Pre-forking multi-process server.
+
+The parent imports the app once, binds the listening socket and forks
+``workers`` children that each serve it with a threaded WSGI server; the
+kernel hands accepted connections to whichever worker is waiting. Workers
+that die are replaced. SIGTERM or SIGINT stops every worker, and each
+flushes its buffered clicks before exiting.
+"""
+import logging
+import os
+import signal
+import socket
+import time
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+
+class _Stop(Exception):
+    pass
+
+
+def _raise_stop(signum, frame):
+    raise _Stop()
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def run_worker(app, sock, on_exit=None):
+    """Serve ``sock`` in a forked child until SIGTERM/SIGINT, then exit."""
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, _raise_interrupt)
+        signal.signal(signal.SIGINT, _raise_interrupt)
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+        server.serve_forever()
+    except BaseException:
+        logger.exception('Worker %d failed', os.getpid())
+        code = 1
+    finally:
+        try:
+            if on_exit is not None:
+                on_exit()
+        finally:
+            # Never return into the parent's call stack
+            os._exit(code)
+
+
+def serve(app, host='127.0.0.1', port=5000, workers=4, before_fork=None, on_exit=None, backlog=2048):
+    """Run ``workers`` forked copies of ``app`` on one socket until stopped.
+
+    ``before_fork`` runs in the parent before forking, to close connections
+    the children must not share; ``on_exit`` runs in each child as it stops.
+    """
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.set_inheritable(True)
+    children = {}
+
+    def spawn():
+        if before_fork is not None:
+            before_fork()
+        pid = os.fork()
+        if pid == 0:
+            run_worker(app, sock, on_exit)
+        children[pid] = time.monotonic()
+
+    previous = {number: signal.signal(number, _raise_stop) for number in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        logger.info('Serving on http://%s:%d with %d workers', host, sock.getsockname()[1], workers)
+        for _ in range(workers):
+            spawn()
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            logger.warning('Worker %d exited with status %d; restarting', pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < 1:
+                # Do not spin when workers fail right after starting
+                time.sleep(1)
+            spawn()
+    except _Stop:
+        pass
+    finally:
+        for number, handler in previous.items():
+            signal.signal(number, handler)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
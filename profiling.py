@@ -0,0 +1,154 @@
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import g, request
+
+from metrics import QueryTrace
+
+PROFILE_NAME = re.compile(r'^\d+-\d+-[\w.]+\.json$')
+
+
+def profile_summary(profiler, limit=50):
+    """The ``limit`` functions with the highest cumulative time."""
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [{
+        "function": f'{filename}:{line}({name})',
+        "calls": calls,
+        "primitive_calls": primitive_calls,
+        "total_seconds": total,
+        "cumulative_seconds": cumulative,
+    } for (filename, line, name), (primitive_calls, calls, total, cumulative, _) in rows]
+
+
+class RequestProfiler:
+    """Profiles sampled requests and keeps the newest results on disk.
+
+    A request is profiled when ``PROFILE_SAMPLE_RATE`` selects it, or when
+    it carries ``PROFILE_HEADER`` set to ``ADMIN_TOKEN``. For those requests
+    the view runs under cProfile and every SQL statement and connection is
+    traced; the result is written as one JSON file to ``PROFILE_DIR``,
+    which keeps at most ``PROFILE_MAX_FILES`` files. Other requests only pay
+    for the sampling check.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.start)
+        app.after_request(self.record_status)
+        app.teardown_request(self.finish)
+
+    @property
+    def directory(self):
+        directory = self.app.config['PROFILE_DIR']
+        if not directory:
+            return os.path.join(self.app.instance_path, 'profiles')
+        return os.path.join(self.app.root_path, directory)
+
+    def sampled(self):
+        config = self.app.config
+        rate = config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return 'sample'
+        token = config['ADMIN_TOKEN']
+        value = request.headers.get(config['PROFILE_HEADER']) if token else None
+        if value and hmac.compare_digest(value.encode(), token.encode()):
+            return 'header'
+        return None
+
+    def start(self):
+        trigger = self.sampled()
+        if trigger is None:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return
+        g.profile = (trigger, profiler, QueryTrace().__enter__(), time.time(), time.perf_counter())
+
+    def record_status(self, response):
+        if 'profile' in g:
+            g.profile_status = response.status_code
+        return response
+
+    def finish(self, exc=None):
+        state = g.pop('profile', None)
+        if state is None:
+            return
+        trigger, profiler, trace, started_at, started = state
+        profiler.disable()
+        trace.__exit__(None, None, None)
+        result = {
+            "method": request.method,
+            "path": request.full_path if request.query_string else request.path,
+            "endpoint": request.endpoint,
+            "status": g.pop('profile_status', 500),
+            "trigger": trigger,
+            "started_at": started_at,
+            "duration_ms": (time.perf_counter() - started) * 1000,
+            "connections_opened": trace.connections_opened,
+            "connections_borrowed": trace.connections_borrowed,
+            "query_count": len(trace.queries),
+            "queries": trace.queries,
+            "profile": profile_summary(profiler),
+        }
+        if exc is not None:
+            result["error"] = repr(exc)
+        self.save(result)
+
+    def save(self, result):
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        endpoint = re.sub(r'[^\w.]', '_', result['endpoint'] or 'unmatched')
+        name = f'{time.time_ns()}-{sequence}-{endpoint}.json'
+        temporary = os.path.join(directory, f'.{name}.tmp')
+        with open(temporary, 'w') as output:
+            json.dump(result, output, indent=1)
+        os.replace(temporary, os.path.join(directory, name))
+        self.prune()
+        return name
+
+    def prune(self):
+        names = self.names()
+        for name in names[self.app.config['PROFILE_MAX_FILES']:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def names(self):
+        """Profile file names, newest first."""
+        try:
+            names = [name for name in os.listdir(self.directory) if PROFILE_NAME.match(name)]
+        except FileNotFoundError:
+            return []
+        return sorted(names, key=lambda name: tuple(int(part) for part in name.split('-', 2)[:2]), reverse=True)
+
+    def list(self):
+        profiles = []
+        for name in self.names():
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            profiles.append({"name": name, "size": size, "created": int(name.split('-', 1)[0]) / 1e9})
+        return profiles
@@ -0,0 +1,120 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """Per-client token buckets in a bounded table.
+
+    A bucket holds up to ``burst`` tokens and refills at ``rate`` tokens per
+    second. Buckets that have been idle long enough to refill completely
+    are the same as new ones, so they are dropped as the table is touched.
+    Beyond ``max_keys`` buckets the least recently used one is dropped,
+    which at worst hands a busy client a full bucket again.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.evictions = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """Spend a token for ``key``; returns 0, or the seconds until one is available."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._buckets.get(key)
+            if entry is None:
+                tokens = burst
+            else:
+                tokens = min(burst, entry[0] + (now - entry[1]) * rate)
+                self._buckets.move_to_end(key)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            # The bucket is full again at this time; expiring it then is lossless
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self._expire(now)
+            return wait
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, entry = next(iter(buckets.items()))
+            if entry[2] > now and len(buckets) <= self.max_keys:
+                break
+            if entry[2] > now:
+                self.evictions += 1
+            del buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoadShedder:
+    """Tracks requests in flight and recent latency to decide what to refuse.
+
+    ``level`` is 0 while in-flight requests and the latency moving average
+    stay under ``max_in_flight`` and ``max_latency`` (either may be None),
+    1 once one of them is crossed and 2 at twice the threshold. Callers
+    refuse their cheapest-to-lose routes first. Requests counted in
+    ``queued`` are waiting for a thread and count as in flight.
+
+    Only finished requests update the latency average, so it also halves
+    every ``half_life`` seconds without one. Otherwise refusing every
+    request after a slow spell would keep it high for good.
+    """
+
+    def __init__(self, max_in_flight=None, max_latency=None, smoothing=0.1, half_life=1.0):
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+        self.half_life = half_life
+        self.in_flight = 0
+        self.queued = 0
+        self.latency = 0.0
+        self.sampled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def current_latency(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.latency * 0.5 ** (max(0.0, now - self.sampled_at) / self.half_life)
+
+    def level(self, now=None):
+        ratio = 0.0
+        if self.max_in_flight:
+            ratio = (self.in_flight + self.queued) / self.max_in_flight
+        if self.max_latency:
+            ratio = max(ratio, self.current_latency(now) / self.max_latency)
+        return 2 if ratio >= 2 else 1 if ratio >= 1 else 0
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def exit(self, duration, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.in_flight -= 1
+            latency = self.current_latency(now)
+            self.latency = latency + self.smoothing * (duration - latency)
+            self.sampled_at = now
+
+    def wait(self, delta):
+        with self._lock:
+            self.queued += delta
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "queued": self.queued, "latency": self.current_latency()}
+
+
+def retry_after(seconds):
+    """``Retry-After`` value: whole seconds, rounded up, at least 1."""
+    return str(max(1, math.ceil(seconds)))
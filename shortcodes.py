@@ -0,0 +1,132 @@
+import random
+import threading
+
+from metrics import SHORTCODE_BLOCKS, SHORTCODE_RETRIES
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+BASE = len(ALPHABET)
+
+# Multiplier for the id scramble. It is prime (and not 2 or 31), so it is
+# coprime with every power of 62 and the mapping below is a bijection.
+SCRAMBLE_MULTIPLIER = 1580030173
+SCRAMBLE_OFFSET = 916132831
+
+
+def base62_encode(number, length):
+    chars = []
+    while number:
+        number, digit = divmod(number, BASE)
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars)).rjust(length, ALPHABET[0])
+
+
+def scramble(number, length):
+    """Bijectively map ``number`` onto ``[0, 62 ** length)``."""
+    modulus = BASE ** length
+    return (number * SCRAMBLE_MULTIPLIER + SCRAMBLE_OFFSET) % modulus
+
+
+def random_code(cursor, length=6):
+    while True:
+        code = ''.join(random.choice(ALPHABET) for _ in range(length))
+        cursor.execute('SELECT shorturl FROM urls WHERE shorturl = ?', (code,))
+        if not cursor.fetchone():
+            return code
+        SHORTCODE_RETRIES.inc(('random',))
+
+
+class RandomCodeGenerator:
+    """Random codes checked against the table one candidate at a time."""
+
+    name = 'random'
+
+    def __init__(self, length=6, **options):
+        self.length = length
+
+    def next_code(self, db):
+        return random_code(db.cursor(), self.length)
+
+    def next_codes(self, db, count):
+        return [self.next_code(db) for _ in range(count)]
+
+
+class SequenceCodeGenerator:
+    """Codes derived from a database sequence, without probing the table.
+
+    Each process reserves ``block_size`` ids at a time from the
+    ``code_sequence`` table and hands them out from memory, so most codes
+    cost no database round trip and workers never compete for the same id.
+    Ids are scrambled into the ``62 ** length`` keyspace so consecutive
+    codes do not look sequential. Once a keyspace is used up codes grow by
+    one character. ``reserve_block`` commits, so ``next_code`` must not be
+    called with a transaction open.
+    """
+
+    name = 'sequence'
+
+    def __init__(self, length=6, block_size=1000, scramble=True, sequence='shorturl'):
+        self.length = length
+        self.block_size = block_size
+        self.scramble = scramble
+        self.sequence = sequence
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def reserve_block(self, db, size=None):
+        size = size or self.block_size
+        rows = db.execute('UPDATE code_sequence SET next_value = next_value + ? WHERE name = ? RETURNING next_value',
+                          (size, self.sequence)).fetchall()
+        db.commit()
+        SHORTCODE_BLOCKS.inc()
+        end = rows[0][0]
+        return end - size, end
+
+    def next_id(self, db):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self.reserve_block(db)
+            value = self._next
+            self._next += 1
+            return value
+
+    def next_ids(self, db, count):
+        """Hand out ``count`` ids, reserving whatever is missing in one go."""
+        with self._lock:
+            ids = list(range(self._next, min(self._end, self._next + count)))
+            self._next += len(ids)
+            missing = count - len(ids)
+            if missing:
+                blocks = -(-missing // self.block_size)
+                start, self._end = self.reserve_block(db, blocks * self.block_size)
+                ids.extend(range(start, start + missing))
+                self._next = start + missing
+            return ids
+
+    def encode(self, value):
+        length = self.length
+        while value >= BASE ** length:
+            length += 1
+        if self.scramble:
+            value = scramble(value, length)
+        return base62_encode(value, length)
+
+    def next_code(self, db):
+        return self.encode(self.next_id(db))
+
+    def next_codes(self, db, count):
+        return [self.encode(value) for value in self.next_ids(db, count)]
+
+
+GENERATORS = {
+    'random': RandomCodeGenerator,
+    'sequence': SequenceCodeGenerator,
+}
+
+
+def create_generator(name, **options):
+    try:
+        generator_class = GENERATORS[name]
+    except KeyError:
+        raise ValueError(f'Unknown short code generator: {name!r}') from None
+    return generator_class(**options)
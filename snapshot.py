@@ -0,0 +1,261 @@
+"""Immutable, memory-mapped redirect snapshots.
+
+A snapshot is a cdb-style hash table compiled from the link table:
+
+    header  magic, slot count, link count, highest link id, build time,
+            id stream count, then the highest link id in each stream
+    slots   (crc32 of the short code, file offset of its record) pairs,
+            open addressing with linear probing; offset 0 marks a free slot
+    heap    records of (id, expiry time, redirect status, cache max-age,
+            code length, URL length, code, URL); 0 stands for no expiry
+            and the default status, -1 for the default max-age
+
+Readers map the file read-only, so every worker on a machine shares one
+page-cached copy. A lookup hashes the code, unpacks a few integers straight
+from the map and decodes only the long URL it returns.
+"""
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'URLSNAP4'
+HEADER = struct.Struct('<8sQQQdQ')
+SLOT = struct.Struct('<QQ')
+RECORD = struct.Struct('<qqHiHI')
+
+
+def build_snapshot(rows, path, load_factor=0.5, streams=1):
+    """Compile storage rows into a snapshot at ``path``.
+
+    The file is written next to ``path`` and renamed over it, so readers
+    see either the old or the new snapshot. ``streams`` is the storage's
+    ``id_streams``; the highest id of each is kept so links created later
+    can be found. Returns the number of links.
+    """
+    built_at = time.time()
+    directory = os.path.dirname(os.path.abspath(path))
+    hashes = array('Q')
+    offsets = array('Q')
+    marks = array('Q', bytes(8 * streams))
+    with tempfile.TemporaryFile(dir=directory) as heap:
+        position = 0
+        for row in rows:
+            url_id, longurl, shorturl, redirect_status, cache_max_age = row[:5]
+            expires_at = row[7]
+            if longurl is None or shorturl is None:
+                continue
+            code = shorturl.encode('utf-8')
+            url = longurl.encode('utf-8')
+            heap.write(RECORD.pack(url_id, expires_at or 0, redirect_status or 0,
+                                   -1 if cache_max_age is None else cache_max_age, len(code), len(url)))
+            heap.write(code)
+            heap.write(url)
+            hashes.append(zlib.crc32(code))
+            offsets.append(position)
+            position += RECORD.size + len(code) + len(url)
+            marks[url_id % streams] = max(marks[url_id % streams], url_id)
+
+        slot_count = 8
+        while slot_count * load_factor < len(hashes):
+            slot_count *= 2
+        mask = slot_count - 1
+        heap_start = HEADER.size + 8 * streams + SLOT.size * slot_count
+        table = array('Q', bytes(SLOT.size * slot_count))
+        for code_hash, offset in zip(hashes, offsets):
+            slot = code_hash & mask
+            while table[2 * slot + 1]:
+                slot = (slot + 1) & mask
+            table[2 * slot] = code_hash
+            table[2 * slot + 1] = heap_start + offset
+        if sys.byteorder != 'little':
+            table.byteswap()
+            marks.byteswap()
+
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'wb') as output:
+                output.write(HEADER.pack(MAGIC, slot_count, len(hashes), max(marks), built_at, streams))
+                marks.tofile(output)
+                table.tofile(output)
+                heap.seek(0)
+                shutil.copyfileobj(heap, output)
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+    return len(hashes)
+
+
+class Snapshot:
+    """Read-only view of one snapshot file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        magic, self.slot_count, self.count, self.max_id, self.built_at, streams = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a redirect snapshot')
+        self.marks = struct.unpack_from(f'<{streams}Q', self._map, HEADER.size)
+        self._slots = HEADER.size + 8 * streams
+        self._mask = self.slot_count - 1
+
+    def get(self, code):
+        """``(id, longurl, redirect_status, cache_max_age, expires_at)`` for ``code``, or None."""
+        key = code.encode('utf-8')
+        code_hash = zlib.crc32(key)
+        data = self._map
+        slot = code_hash & self._mask
+        while True:
+            stored_hash, offset = SLOT.unpack_from(data, self._slots + SLOT.size * slot)
+            if not offset:
+                return None
+            if stored_hash == code_hash:
+                url_id, expires_at, redirect_status, cache_max_age, code_length, url_length = \
+                    RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                if code_length == len(key) and data.find(key, start, start + code_length) == start:
+                    return (url_id, data[start + code_length:start + code_length + url_length].decode('utf-8'),
+                            redirect_status or None, None if cache_max_age < 0 else cache_max_age,
+                            expires_at or None)
+            slot = (slot + 1) & self._mask
+
+
+class SnapshotRedirects:
+    """Redirect lookups from a snapshot file plus a small in-memory overlay.
+
+    The file is checked for replacement every ``check_interval`` seconds and
+    swapped in without blocking lookups. Every ``delta_interval`` seconds
+    links created since the snapshot was built (ids above its highest id
+    in each of the storage's id streams) are loaded from ``storage`` into
+    the overlay; ``0`` disables this.
+    Codes changed by this process are marked stale until a newer snapshot
+    arrives, so they fall through to the database.
+    """
+
+    def __init__(self, path, storage=None, check_interval=5.0, delta_interval=5.0):
+        self.path = path
+        self.storage = storage
+        self.check_interval = check_interval
+        self.delta_interval = delta_interval
+        self.snapshot = None
+        self.hits = 0
+        self.delta = {}
+        self._stale = {}
+        self._marks = None
+        self._next_check = 0.0
+        self._next_delta = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, code):
+        self.refresh_if_due()
+        return self.lookup(code)
+
+    def due(self, now=None):
+        """Whether ``refresh_if_due`` has a file check or overlay refresh to do."""
+        now = time.monotonic() if now is None else now
+        return now >= self._next_check or (self._refreshes_delta() and now >= self._next_delta)
+
+    def refresh_if_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now >= self._next_check:
+            self.reload(now)
+        if self._refreshes_delta() and now >= self._next_delta:
+            self.refresh_delta(now)
+
+    def _refreshes_delta(self):
+        return bool(self.delta_interval) and self.snapshot is not None and self.storage is not None
+
+    def lookup(self, code):
+        """The entry for ``code`` in the overlay or snapshot, without checking for updates."""
+        if code in self._stale:
+            return None
+        found = self.delta.get(code)
+        if found is None and self.snapshot is not None:
+            found = self.snapshot.get(code)
+        if found is not None:
+            self.hits += 1
+        return found
+
+    def reload(self, now=None):
+        # Whoever holds the lock is already checking; lookups never wait
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = (now or time.monotonic()) + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            current = self.snapshot
+            if current is not None and current.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                return False
+            try:
+                snapshot = Snapshot(self.path)
+            except (OSError, ValueError):
+                logger.exception('Failed to open redirect snapshot %s', self.path)
+                return False
+            streams = self.storage.id_streams if self.storage is not None else len(snapshot.marks)
+            if len(snapshot.marks) != streams:
+                logger.error('Redirect snapshot %s was built for %d shards, not %d; rebuild it',
+                             self.path, len(snapshot.marks), streams)
+                return False
+            # The old map is unmapped once the last lookup using it returns
+            self.snapshot = snapshot
+            marks = snapshot.marks if self._marks is None else tuple(map(max, self._marks, snapshot.marks))
+            self.delta = {code: value for code, value in list(self.delta.items())
+                          if value[0] > snapshot.marks[value[0] % streams]}
+            self._stale = {code: when for code, when in list(self._stale.items()) if when >= snapshot.built_at}
+            self._marks = marks
+            return True
+        finally:
+            self._lock.release()
+
+    def refresh_delta(self, now=None):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_delta = (now or time.monotonic()) + self.delta_interval
+            delta = dict(self.delta)
+            marks = list(self._marks)
+            for row in self.storage.iter_created(self._marks):
+                delta[row[2]] = (row[0], row[1], row[3], row[4], row[7])
+                stream = row[0] % len(marks)
+                marks[stream] = max(marks[stream], row[0])
+            self.delta, self._marks = delta, tuple(marks)
+        except Exception:
+            logger.exception('Failed to load links created since the redirect snapshot')
+        finally:
+            self._lock.release()
+
+    def is_stale(self, code):
+        return code in self._stale
+
+    def invalidate(self, code):
+        self._stale[code] = time.time()
+        self.delta.pop(code, None)
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "loaded": snapshot is not None,
+            "links": snapshot.count if snapshot else 0,
+            "max_id": snapshot.max_id if snapshot else 0,
+            "delta": len(self.delta),
+            "stale": len(self._stale),
+            "hits": self.hits,
+        }
@@ -0,0 +1,732 @@
+"""Link storage backends.
+
+Routes talk to a ``Storage`` instead of issuing SQL. Rows are
+``(id, longurl, shorturl, redirect_status, cache_max_age, version,
+updated_at, expires_at)`` sequences; redirect lookups return ``(id,
+longurl, redirect_status, cache_max_age, expires_at)``. ``SQLiteStorage`` keeps everything in
+one database, ``ShardedStorage`` spreads links over several SQLite files by
+a hash of their short code, and ``MemoryStorage`` keeps them in dicts for
+tests and benchmarks.
+"""
+import contextlib
+import hashlib
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from database import Database
+from metrics import SHORTCODE_RETRIES
+from migrations import LONGURL, SEARCH_INSERT_TRIGGER, has_search_index
+from normalize import split_origin, url_hash
+from shortcodes import SequenceCodeGenerator
+
+MAX_ID = 2 ** 63 - 1
+
+FULL_LONGURL = LONGURL.format(row='urls')
+COLUMNS = f'id, {FULL_LONGURL} AS longurl, shorturl, redirect_status, cache_max_age, version, updated_at, expires_at'
+REDIRECT_COLUMNS = f'id, {FULL_LONGURL} AS longurl, redirect_status, cache_max_age, expires_at'
+# Per-link settings that can be changed through ``update``
+SETTINGS = ('redirect_status', 'cache_max_age', 'expires_at')
+NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Batches at least this large are added to the search index in one statement
+BULK_INDEX_THRESHOLD = 1000
+
+
+def like_pattern(query):
+    return '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class Storage:
+    """Operations the application needs from a link store.
+
+    Subclasses implement the lookups and the ``insert``/``insert_many``
+    primitives; creating links with deduplication and code retries is
+    shared. ``insert`` raises ``sqlite3.IntegrityError`` when the short code
+    or the URL is already stored.
+    """
+
+    attempts = 5
+    generator_name = None
+    # Ids only increase within each ``id % id_streams`` class
+    id_streams = 1
+
+    def find_by_longurl(self, longurl):
+        """``(id, shorturl)`` of the link for ``longurl``, or None."""
+        longurl_hash = url_hash(longurl)
+        return self.find_by_hashes([longurl_hash]).get(longurl_hash)
+
+    def create(self, longurl, **settings):
+        """Shorten ``longurl``, reusing an existing link for the same URL.
+
+        Returns ``(id, shorturl, created)``. ``settings`` only apply to a new
+        link. A code can only clash with a legacy random code, in which case
+        the next one is tried. An expired link for the same URL is replaced.
+        """
+        longurl_hash = url_hash(longurl)
+        self.purge_expired([longurl_hash])
+        existing = self.find_by_hashes([longurl_hash]).get(longurl_hash)
+        if existing:
+            return existing[0], existing[1], False
+
+        for _ in range(self.attempts):
+            code = self.next_code()
+            try:
+                return self.insert(longurl, code, longurl_hash, **settings), code, True
+            except sqlite3.IntegrityError:
+                # Either a concurrent request stored the same URL first, or
+                # the code is already taken
+                existing = self.find_by_hashes([longurl_hash]).get(longurl_hash)
+                if existing:
+                    return existing[0], existing[1], False
+                SHORTCODE_RETRIES.inc((self.generator_name,))
+        raise sqlite3.IntegrityError('Could not allocate an unused short code')
+
+    def create_many(self, longurls, hashes=None, settings=None):
+        """Shorten many URLs with one set-based lookup and one bulk insert.
+
+        Returns ``(id, shorturl, created)`` for each URL in input order. Only
+        the first occurrence of a URL repeated within the batch counts as
+        created, with its ``settings`` dict if ``settings`` is given. Rows
+        whose code turned out to be taken are retried with fresh codes.
+        ``hashes`` may pass in the URLs' precomputed hashes.
+        """
+        if hashes is None:
+            hashes = [url_hash(longurl) for longurl in longurls]
+        if settings is None:
+            settings = itertools.repeat({})
+        self.purge_expired(list(set(hashes)))
+        found = self.find_by_hashes(list(set(hashes)))
+        pending = {}
+        for longurl_hash, longurl, link_settings in zip(hashes, longurls, settings):
+            if longurl_hash not in found and longurl_hash not in pending:
+                pending[longurl_hash] = (longurl, *(link_settings.get(name) for name in SETTINGS))
+
+        created = set()
+        for _ in range(self.attempts):
+            if not pending:
+                break
+            codes = self.next_codes(len(pending))
+            rows = [(longurl, code, longurl_hash, *values)
+                    for (longurl_hash, (longurl, *values)), code in zip(pending.items(), codes)]
+            self.insert_many(rows)
+            stored = self.find_by_hashes(list(pending))
+            for _, code, longurl_hash, *_ in rows:
+                if longurl_hash in stored:
+                    found[longurl_hash] = stored[longurl_hash]
+                    if stored[longurl_hash][1] == code:
+                        created.add(longurl_hash)
+                    del pending[longurl_hash]
+            if pending:
+                SHORTCODE_RETRIES.inc((self.generator_name,), len(pending))
+        if pending:
+            raise sqlite3.IntegrityError('Could not allocate unused short codes')
+
+        results = []
+        for longurl_hash in hashes:
+            url_id, shorturl = found[longurl_hash]
+            results.append((url_id, shorturl, longurl_hash in created))
+            created.discard(longurl_hash)
+        return results
+
+    def list_page(self, after=0, limit=100):
+        """Up to ``limit`` links with ids above ``after``, in id order."""
+        return list(self.iter_urls(after, limit))
+
+    def iter_created(self, marks):
+        """Yield links with ids above the highest id ``marks`` holds for their id stream."""
+        return self.iter_urls(marks[0])
+
+    def purge_expired(self, hashes):
+        """Delete expired links for these URL hashes so they can be recreated."""
+
+    def delete_expired(self, now, limit=500):
+        """Delete up to ``limit`` links that expired by ``now``; returns their codes."""
+        return []
+
+    def incremental_vacuum(self, pages=1000):
+        """Return up to ``pages`` free pages to the filesystem; returns the count."""
+        return 0
+
+    def vacuum(self, incremental=False):
+        """Rebuild the database files, switching to incremental auto-vacuum if asked."""
+
+    def databases(self):
+        """The ``Database`` objects holding the links, for change watching."""
+        return []
+
+    def close(self):
+        pass
+
+
+INSERT_MANY = ('INSERT OR IGNORE INTO urls (longurl, shorturl, longurl_hash, redirect_status, cache_max_age, '
+               f'expires_at, host_id, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, {NOW})')
+
+
+class SQLiteStorage(Storage):
+    """Links in a single SQLite database managed by ``database``.
+
+    Request code uses the connections ``database`` lends to the current app
+    context; background work (click flushes, filter builds) borrows its own.
+    The scheme and host of each URL are interned in the ``hosts`` table.
+    """
+
+    def __init__(self, database, generator, attempts=5):
+        self.database = database
+        self.generator = generator
+        self.generator_name = getattr(generator, 'name', None)
+        self.attempts = attempts
+
+    def connection(self, readonly=False):
+        return self.database.connection(readonly)
+
+    @contextlib.contextmanager
+    def borrowed(self):
+        db = self.database.acquire()
+        try:
+            yield db
+        finally:
+            self.database.release(db)
+
+    def get_by_code(self, code):
+        """``(id, longurl, redirect_status, cache_max_age, expires_at)`` for ``code``, or None."""
+        return self.connection(readonly=True).execute(
+            f'SELECT {REDIRECT_COLUMNS} FROM urls WHERE shorturl = ?', (code,)).fetchone()
+
+    def get_by_id(self, url_id):
+        return self.connection().execute(f'SELECT {COLUMNS} FROM urls WHERE id = ?', (url_id,)).fetchone()
+
+    def find_by_hashes(self, hashes, chunk_size=500):
+        """Map each URL hash already stored to its ``(id, shorturl)``."""
+        db = self.connection()
+        found = {}
+        for start in range(0, len(hashes), chunk_size):
+            chunk = hashes[start:start + chunk_size]
+            placeholders = ','.join('?' * len(chunk))
+            rows = db.execute(f'SELECT longurl_hash, id, shorturl FROM urls WHERE longurl_hash IN ({placeholders})',
+                              chunk)
+            for longurl_hash, url_id, shorturl in rows:
+                found[longurl_hash] = (url_id, shorturl)
+        return found
+
+    def next_code(self):
+        return self.generator.next_code(self.connection())
+
+    def next_codes(self, count):
+        return self.generator.next_codes(self.connection(), count)
+
+    def host_ids(self, db, origins):
+        """Map each ``scheme://host`` in ``origins`` to its id, adding new ones.
+
+        New hosts are committed straight away, so a link that fails to
+        insert and rolls back cannot take a host another link refers to.
+        """
+        ids = {}
+        missing = list(set(origins))
+        for attempt in range(2):
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                ids.update(db.execute(f"SELECT origin, id FROM hosts WHERE origin IN ({','.join('?' * len(chunk))})",
+                                      chunk).fetchall())
+            missing = [origin for origin in missing if origin not in ids]
+            if not missing or attempt:
+                break
+            db.executemany('INSERT OR IGNORE INTO hosts (origin) VALUES (?)', [(origin,) for origin in missing])
+            db.commit()
+        return ids
+
+    def _split(self, db, longurls):
+        """``(host_id, rest)`` for each URL; URLs without a host keep a NULL id."""
+        parts = [split_origin(longurl) for longurl in longurls]
+        ids = self.host_ids(db, [origin for origin, _ in parts if origin is not None])
+        return [(ids.get(origin), rest) for origin, rest in parts]
+
+    def insert(self, longurl, code, longurl_hash, redirect_status=None, cache_max_age=None, expires_at=None):
+        db = self.connection()
+        [(host_id, rest)] = self._split(db, [longurl])
+        try:
+            cursor = db.execute('INSERT INTO urls (longurl, shorturl, longurl_hash, redirect_status, cache_max_age, '
+                                f'expires_at, host_id, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, {NOW})',
+                                (rest, code, longurl_hash, redirect_status, cache_max_age, expires_at, host_id))
+            db.commit()
+        except sqlite3.IntegrityError:
+            db.rollback()
+            raise
+        return cursor.lastrowid
+
+    def insert_many(self, rows):
+        """Insert ``(longurl, shorturl, longurl_hash)`` rows, skipping clashes.
+
+        Rows may go on with ``redirect_status, cache_max_age, expires_at``.
+        """
+        db = self.connection()
+        rows = [(rest, *row[1:], *(None,) * (6 - len(row)), host_id)
+                for row, (host_id, rest) in zip(rows, self._split(db, [row[0] for row in rows]))]
+        if len(rows) < BULK_INDEX_THRESHOLD or not has_search_index(db):
+            db.executemany(INSERT_MANY, rows)
+            db.commit()
+            return
+        # Feeding the search index once per batch is several times faster
+        # than its per-row trigger. The trigger is dropped and restored in
+        # the same transaction, so no other connection sees it missing.
+        if not db.in_transaction:
+            db.execute('BEGIN IMMEDIATE')
+        try:
+            start = db.execute('SELECT coalesce(max(id), 0) FROM urls').fetchone()[0]
+            db.execute('DROP TRIGGER urls_search_insert')
+            db.executemany(INSERT_MANY, rows)
+            db.execute('INSERT INTO urls_search (rowid, longurl, shorturl) '
+                       f'SELECT id, {FULL_LONGURL}, shorturl FROM urls WHERE id > ?', (start,))
+            db.execute(SEARCH_INSERT_TRIGGER)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+    def update(self, url_id, longurl=None, **settings):
+        """Change a link's URL and/or ``SETTINGS`` and bump its version.
+
+        Returns the updated row, or None if the link does not exist.
+        """
+        db = self.connection()
+        if db.execute('SELECT id FROM urls WHERE id = ?', (url_id,)).fetchone() is None:
+            return None
+        columns = {name: settings[name] for name in SETTINGS if name in settings}
+        if longurl is not None:
+            [(host_id, rest)] = self._split(db, [longurl])
+            columns.update(longurl=rest, host_id=host_id, longurl_hash=url_hash(longurl))
+
+        def execute():
+            assignments = ''.join(f'{name} = ?, ' for name in columns)
+            db.execute(f'UPDATE urls SET {assignments}version = version + 1, updated_at = {NOW} WHERE id = ?',
+                       (*columns.values(), url_id))
+
+        try:
+            execute()
+        except sqlite3.IntegrityError:
+            # Another link already owns this URL and stays the dedupe target
+            columns['longurl_hash'] = None
+            execute()
+        db.commit()
+        return self.get_by_id(url_id)
+
+    def delete(self, url_id):
+        """Delete a link; returns its short code, or None if it did not exist."""
+        db = self.connection()
+        rows = db.execute('DELETE FROM urls WHERE id = ? RETURNING shorturl', (url_id,)).fetchall()
+        db.commit()
+        return rows[0][0] if rows else None
+
+    def iter_urls(self, after=0, limit=None, batch_size=500):
+        """Yield links with ids above ``after`` in id order."""
+        cursor = self.connection().cursor()
+        if limit is None:
+            cursor.execute(f'SELECT {COLUMNS} FROM urls WHERE id > ? ORDER BY id', (after,))
+        else:
+            cursor.execute(f'SELECT {COLUMNS} FROM urls WHERE id > ? ORDER BY id LIMIT ?', (after, limit))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def list_page(self, after=0, limit=100):
+        return self.connection().execute(f'SELECT {COLUMNS} FROM urls WHERE id > ? ORDER BY id LIMIT ?',
+                                         (after, limit)).fetchall()
+
+    def list_recent(self, query='', before=None, limit=50):
+        """Newest-first page of links with ids below ``before``.
+
+        ``query`` matches a substring of the long URL or short code through
+        the trigram search index; queries shorter than a trigram (or
+        databases without FTS5) fall back to a LIKE scan.
+        """
+        if before is None:
+            before = MAX_ID
+        db = self.connection()
+        if not query:
+            cursor = db.execute(f'SELECT {COLUMNS} FROM urls WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                (before, limit))
+        elif len(query) >= 3 and has_search_index(db):
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor = db.execute(f'SELECT {COLUMNS} FROM urls WHERE id IN (SELECT rowid FROM urls_search '
+                                'WHERE urls_search MATCH ? AND rowid < ? ORDER BY rowid DESC LIMIT ?) '
+                                'ORDER BY id DESC', (phrase, before, limit))
+        else:
+            pattern = like_pattern(query)
+            cursor = db.execute(f"SELECT {COLUMNS} FROM urls WHERE id < ? "
+                                f"AND ({FULL_LONGURL} LIKE ? ESCAPE '\\' OR shorturl LIKE ? ESCAPE '\\') "
+                                "ORDER BY id DESC LIMIT ?", (before, pattern, pattern, limit))
+        return cursor.fetchall()
+
+    def click_stats(self, url_id, since):
+        """All-time click total and ``(minute, count)`` buckets from ``since``."""
+        db = self.connection()
+        total = db.execute('SELECT coalesce(sum(count), 0) FROM clicks WHERE url_id = ?', (url_id,)).fetchone()[0]
+        buckets = db.execute('SELECT minute, count FROM clicks WHERE url_id = ? AND minute >= ? ORDER BY minute',
+                             (url_id, since)).fetchall()
+        return total, buckets
+
+    def record_clicks(self, counts):
+        """Add ``{(url_id, minute): count}`` to the stored click counters."""
+        with self.borrowed() as db:
+            # Selecting through urls skips links deleted since the click
+            db.executemany(
+                'INSERT INTO clicks (url_id, minute, count) SELECT id, ?, ? FROM urls WHERE id = ? '
+                'ON CONFLICT (url_id, minute) DO UPDATE SET count = count + excluded.count',
+                [(minute, count, url_id) for (url_id, minute), count in counts.items()])
+            db.commit()
+
+    def count(self):
+        with self.borrowed() as db:
+            return db.execute('SELECT count(*) FROM urls').fetchone()[0]
+
+    def iter_codes(self):
+        with self.borrowed() as db:
+            for row in db.execute('SELECT shorturl FROM urls'):
+                yield row[0]
+
+    def purge_expired(self, hashes, chunk_size=500):
+        db = self.connection()
+        now = int(time.time())
+        for start in range(0, len(hashes), chunk_size):
+            chunk = hashes[start:start + chunk_size]
+            where = f"longurl_hash IN ({','.join('?' * len(chunk))}) AND expires_at <= ?"
+            # Checking first keeps the common case from taking the write lock
+            if db.execute(f'SELECT 1 FROM urls WHERE {where} LIMIT 1', (*chunk, now)).fetchone():
+                db.execute(f'DELETE FROM urls WHERE {where}', (*chunk, now))
+                db.commit()
+
+    def delete_expired(self, now, limit=500):
+        # Each batch is its own short transaction found through the expiry
+        # index, so redirects and creates are never blocked for long
+        with self.borrowed() as db:
+            rows = db.execute('DELETE FROM urls WHERE id IN (SELECT id FROM urls WHERE expires_at <= ? '
+                              'ORDER BY expires_at LIMIT ?) RETURNING shorturl', (now, limit)).fetchall()
+            db.commit()
+        return [row[0] for row in rows]
+
+    def incremental_vacuum(self, pages=1000):
+        with self.borrowed() as db:
+            before = db.execute('PRAGMA freelist_count').fetchone()[0]
+            # execute() would step the pragma once, freeing a single page
+            db.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+            return before - db.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def vacuum(self, incremental=False):
+        with self.borrowed() as db:
+            if incremental:
+                db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('VACUUM')
+
+    def databases(self):
+        return [self.database]
+
+    def close(self):
+        self.database.close()
+
+
+class ShardedStorage(Storage):
+    """Links spread over several ``SQLiteStorage`` shards.
+
+    A link lives in the shard picked by a hash of its short code, so a
+    redirect touches exactly one file and writes to different shards do not
+    contend for the same lock. Public ids encode the shard as
+    ``local_id * shards + shard``, which keeps them unique and ordered within
+    each shard; listings merge the shards' id-ordered streams. Short codes
+    come from the sequence in the first shard. Duplicate URLs are looked up
+    in every shard, but only rejected by a constraint within one.
+    """
+
+    def __init__(self, shards, generator, attempts=5):
+        self.shards = shards
+        self.id_streams = len(shards)
+        self.generator = generator
+        self.generator_name = getattr(generator, 'name', None)
+        self.attempts = attempts
+
+    def shard_index(self, code):
+        digest = hashlib.blake2b(code.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % len(self.shards)
+
+    def _locate(self, url_id):
+        index = url_id % len(self.shards)
+        return index, self.shards[index], url_id // len(self.shards)
+
+    def _global(self, index, rows):
+        count = len(self.shards)
+        for row in rows:
+            yield (row[0] * count + index,) + tuple(row[1:])
+
+    def _after(self, index, after):
+        return (after - index) // len(self.shards)
+
+    def _before(self, index, before):
+        return None if before is None else -((index - before) // len(self.shards))
+
+    def get_by_code(self, code):
+        index = self.shard_index(code)
+        row = self.shards[index].get_by_code(code)
+        return next(self._global(index, [row])) if row else None
+
+    def get_by_id(self, url_id):
+        index, shard, local_id = self._locate(url_id)
+        row = shard.get_by_id(local_id)
+        return next(self._global(index, [row])) if row else None
+
+    def find_by_hashes(self, hashes):
+        found = {}
+        for index, shard in enumerate(self.shards):
+            for longurl_hash, row in shard.find_by_hashes(hashes).items():
+                found.setdefault(longurl_hash, next(self._global(index, [row])))
+        return found
+
+    def next_code(self):
+        return self.generator.next_code(self.shards[0].connection())
+
+    def next_codes(self, count):
+        return self.generator.next_codes(self.shards[0].connection(), count)
+
+    def insert(self, longurl, code, longurl_hash, **settings):
+        index = self.shard_index(code)
+        return self.shards[index].insert(longurl, code, longurl_hash, **settings) * len(self.shards) + index
+
+    def insert_many(self, rows):
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(self.shard_index(row[1]), []).append(row)
+        for index, shard_rows in by_shard.items():
+            self.shards[index].insert_many(shard_rows)
+
+    def update(self, url_id, longurl=None, **settings):
+        index, shard, local_id = self._locate(url_id)
+        row = shard.update(local_id, longurl, **settings)
+        return next(self._global(index, [row])) if row else None
+
+    def delete(self, url_id):
+        _, shard, local_id = self._locate(url_id)
+        return shard.delete(local_id)
+
+    def iter_urls(self, after=0, limit=None, batch_size=500):
+        streams = [self._global(index, shard.iter_urls(self._after(index, after), limit, batch_size))
+                   for index, shard in enumerate(self.shards)]
+        return itertools.islice(heapq.merge(*streams, key=lambda row: row[0]), limit)
+
+    def iter_created(self, marks):
+        return itertools.chain.from_iterable(self._global(index, shard.iter_urls(self._after(index, mark)))
+                                             for (index, shard), mark in zip(enumerate(self.shards), marks))
+
+    def list_page(self, after=0, limit=100):
+        pages = [list(self._global(index, shard.list_page(self._after(index, after), limit)))
+                 for index, shard in enumerate(self.shards)]
+        return list(itertools.islice(heapq.merge(*pages, key=lambda row: row[0]), limit))
+
+    def list_recent(self, query='', before=None, limit=50):
+        pages = [list(self._global(index, shard.list_recent(query, self._before(index, before), limit)))
+                 for index, shard in enumerate(self.shards)]
+        return list(itertools.islice(heapq.merge(*pages, key=lambda row: row[0], reverse=True), limit))
+
+    def click_stats(self, url_id, since):
+        _, shard, local_id = self._locate(url_id)
+        return shard.click_stats(local_id, since)
+
+    def record_clicks(self, counts):
+        by_shard = {}
+        for (url_id, minute), count in counts.items():
+            index, _, local_id = self._locate(url_id)
+            by_shard.setdefault(index, {})[(local_id, minute)] = count
+        for index, shard_counts in by_shard.items():
+            self.shards[index].record_clicks(shard_counts)
+
+    def count(self):
+        return sum(shard.count() for shard in self.shards)
+
+    def iter_codes(self):
+        return itertools.chain.from_iterable(shard.iter_codes() for shard in self.shards)
+
+    def purge_expired(self, hashes):
+        for shard in self.shards:
+            shard.purge_expired(hashes)
+
+    def delete_expired(self, now, limit=500):
+        return [code for shard in self.shards for code in shard.delete_expired(now, limit)]
+
+    def incremental_vacuum(self, pages=1000):
+        return sum(shard.incremental_vacuum(pages) for shard in self.shards)
+
+    def vacuum(self, incremental=False):
+        for shard in self.shards:
+            shard.vacuum(incremental)
+
+    def databases(self):
+        return [shard.database for shard in self.shards]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class MemoryStorage(Storage):
+    """Links kept in process memory, for tests and benchmarks.
+
+    Codes are derived from an in-memory sequence the same way
+    ``SequenceCodeGenerator`` derives them from the database one.
+    """
+
+    generator_name = 'memory'
+
+    def __init__(self, length=6, attempts=5):
+        self.encoder = SequenceCodeGenerator(length)
+        self.attempts = attempts
+        self._urls = {}
+        self._by_code = {}
+        self._by_hash = {}
+        self._clicks = {}
+        self._ids = itertools.count(1)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def get_by_code(self, code):
+        url_id = self._by_code.get(code)
+        row = self._urls.get(url_id)
+        return (row[0], row[1], row[3], row[4], row[7]) if row else None
+
+    def get_by_id(self, url_id):
+        return self._urls.get(url_id)
+
+    def find_by_hashes(self, hashes):
+        found = {}
+        for longurl_hash in hashes:
+            row = self._urls.get(self._by_hash.get(longurl_hash))
+            if row:
+                found[longurl_hash] = (row[0], row[2])
+        return found
+
+    def next_code(self):
+        with self._lock:
+            return self.encoder.encode(next(self._sequence))
+
+    def next_codes(self, count):
+        with self._lock:
+            return [self.encoder.encode(next(self._sequence)) for _ in range(count)]
+
+    def insert(self, longurl, code, longurl_hash, redirect_status=None, cache_max_age=None, expires_at=None):
+        with self._lock:
+            if code in self._by_code or longurl_hash in self._by_hash:
+                raise sqlite3.IntegrityError('UNIQUE constraint failed')
+            url_id = next(self._ids)
+            self._urls[url_id] = (url_id, longurl, code, redirect_status, cache_max_age, 1, int(time.time()),
+                                  expires_at)
+            self._by_code[code] = url_id
+            self._by_hash[longurl_hash] = url_id
+            return url_id
+
+    def insert_many(self, rows):
+        for row in rows:
+            try:
+                self.insert(*row)
+            except sqlite3.IntegrityError:
+                pass
+
+    def update(self, url_id, longurl=None, **settings):
+        with self._lock:
+            row = self._urls.get(url_id)
+            if row is None:
+                return None
+            if longurl is not None:
+                for key, value in list(self._by_hash.items()):
+                    if value == url_id:
+                        del self._by_hash[key]
+                self._by_hash.setdefault(url_hash(longurl), url_id)
+            redirect_status = settings.get('redirect_status', row[3])
+            cache_max_age = settings.get('cache_max_age', row[4])
+            expires_at = settings.get('expires_at', row[7])
+            row = self._urls[url_id] = (url_id, row[1] if longurl is None else longurl, row[2],
+                                        redirect_status, cache_max_age, row[5] + 1, int(time.time()), expires_at)
+            return row
+
+    def delete(self, url_id):
+        with self._lock:
+            return self._delete(url_id)
+
+    def _delete(self, url_id):
+        row = self._urls.pop(url_id, None)
+        if row is None:
+            return None
+        del self._by_code[row[2]]
+        for key, value in list(self._by_hash.items()):
+            if value == url_id:
+                del self._by_hash[key]
+        for key in [key for key in self._clicks if key[0] == url_id]:
+            del self._clicks[key]
+        return row[2]
+
+    def purge_expired(self, hashes):
+        now = int(time.time())
+        with self._lock:
+            for longurl_hash in hashes:
+                row = self._urls.get(self._by_hash.get(longurl_hash))
+                if row and row[7] is not None and row[7] <= now:
+                    self._delete(row[0])
+
+    def delete_expired(self, now, limit=500):
+        with self._lock:
+            expired = sorted((row[7], row[0]) for row in self._urls.values() if row[7] is not None and row[7] <= now)
+            return [self._delete(url_id) for _, url_id in expired[:limit]]
+
+    def _rows(self):
+        with self._lock:
+            return list(self._urls.values())
+
+    def iter_urls(self, after=0, limit=None, batch_size=500):
+        return itertools.islice((row for row in self._rows() if row[0] > after), limit)
+
+    def list_recent(self, query='', before=None, limit=50):
+        before = MAX_ID if before is None else before
+        query = query.casefold()
+        rows = (row for row in reversed(self._rows()) if row[0] < before
+                and (query in row[1].casefold() or query in row[2].casefold()))
+        return list(itertools.islice(rows, limit))
+
+    def click_stats(self, url_id, since):
+        with self._lock:
+            buckets = sorted((minute, count) for (key, minute), count in self._clicks.items() if key == url_id)
+        return sum(count for _, count in buckets), [bucket for bucket in buckets if bucket[0] >= since]
+
+    def record_clicks(self, counts):
+        with self._lock:
+            for (url_id, minute), count in counts.items():
+                if url_id in self._urls:
+                    self._clicks[(url_id, minute)] = self._clicks.get((url_id, minute), 0) + count
+
+    def count(self):
+        return len(self._urls)
+
+    def iter_codes(self):
+        return iter(list(self._by_code))
+
+
+def shard_path(path, index):
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index}{ext}'
+
+
+def create_storage(app, database, generator):
+    """Build the backend named by ``STORAGE_BACKEND``."""
+    config = app.config
+    backend = config['STORAGE_BACKEND']
+    attempts = config['SHORTCODE_ATTEMPTS']
+    if backend == 'sqlite':
+        return SQLiteStorage(database, generator, attempts)
+    if backend == 'sharded':
+        shards = [SQLiteStorage(Database(app, database.connection_factory,
+                                         path=shard_path(config['DATABASE'], index), name=f'shard{index}'),
+                                generator, attempts)
+                  for index in range(config['STORAGE_SHARDS'])]
+        return ShardedStorage(shards, generator, attempts)
+    if backend == 'memory':
+        return MemoryStorage(config['SHORTCODE_LENGTH'], attempts)
+    raise ValueError(f'Unknown storage backend: {backend!r}')
@@ -0,0 +1,269 @@
+"""Streaming bulk import and export of links as CSV or JSON Lines.
+
+Both directions hold one batch in memory at a time. After each batch,
+imports record the input offset and the highest link id in a checkpoint
+file next to the input, so an interrupted import can resume. A batch is
+stored in a few commits (new hosts, reserved codes, links), so an
+interruption can leave part of one behind. Long URLs are deduplicated,
+which makes replaying it harmless, and its links above the recorded id
+still count as created.
+Exports walk the table in id order and can resume after the last id in a
+partially written file.
+"""
+import csv
+import io
+import json
+import os
+import time
+
+from normalize import url_hash
+
+FORMATS = ('csv', 'jsonl')
+# Snapshot records hold the code length in 16 bits; real codes are far shorter
+MAX_CODE_BYTES = 100
+UNROUTABLE = frozenset('/?#%')
+EXPORT_COLUMNS = ('id', 'longurl', 'shorturl')
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise ValueError(f'Cannot tell the format of {path!r}; pass one of {", ".join(FORMATS)}')
+
+
+def checkpoint_path(path):
+    return path + '.import-progress'
+
+
+def _parse_csv(lines, columns):
+    longurl_index = columns.index('longurl')
+    shorturl_index = columns.index('shorturl') if 'shorturl' in columns else None
+    for row in csv.reader(line.decode('utf-8') for line in lines):
+        if not row:
+            continue
+        longurl = row[longurl_index] if longurl_index < len(row) else None
+        shorturl = row[shorturl_index] if shorturl_index is not None and shorturl_index < len(row) else None
+        yield longurl, shorturl or None
+
+
+def _parse_jsonl(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield None, None
+            continue
+        if isinstance(item, str):
+            yield item, None
+        elif isinstance(item, dict):
+            yield item.get('longurl'), item.get('shorturl') or None
+        else:
+            yield None, None
+
+
+def read_batches(stream, fmt, batch_size, offset=0):
+    """Yield ``(records, end_offset)`` from a binary stream.
+
+    Records are ``(longurl, shorturl)`` pairs, with None for fields that are
+    missing or invalid. ``end_offset`` is where the next batch starts.
+    CSV input needs a header row naming a ``longurl`` column and optionally
+    a ``shorturl`` column; fields may not span lines.
+    """
+    columns = None
+    if fmt == 'csv':
+        columns = next(csv.reader([stream.readline().decode('utf-8-sig')]), [])
+        if 'longurl' not in columns:
+            raise ValueError('CSV input needs a header row with a longurl column')
+    if offset > stream.tell():
+        stream.seek(offset)
+    while True:
+        lines = []
+        for _ in range(batch_size):
+            line = stream.readline()
+            if not line:
+                break
+            lines.append(line)
+        if not lines:
+            return
+        records = list(_parse_csv(lines, columns) if fmt == 'csv' else _parse_jsonl(lines))
+        yield records, stream.tell()
+
+
+def last_link_id(storage):
+    rows = storage.list_recent('', None, 1)
+    return rows[0][0] if rows else 0
+
+
+def usable_code(code, reserved=()):
+    """Whether a supplied short code can be stored and redirected to.
+
+    ``reserved`` holds the first path segments of the app's own routes.
+    """
+    return (bool(code) and len(code.encode('utf-8')) <= MAX_CODE_BYTES and code not in reserved
+            and code.isprintable() and not any(char.isspace() or char in UNROUTABLE for char in code)
+            and code not in ('.', '..'))
+
+
+def import_batch(storage, records, stats, replay_after=None, reserved=()):
+    """Store one batch of ``(longurl, shorturl)`` records.
+
+    Supplied codes are kept unless another link already uses them or they
+    are not ``usable_code``, in which case the URL gets a generated code and
+    is counted as a conflict. When
+    the batch is replayed after an interruption, ``replay_after`` is the
+    highest link id before the interrupted attempt.
+    """
+    valid = [(longurl, shorturl) for longurl, shorturl in records if isinstance(longurl, str) and longurl]
+    stats['invalid'] += len(records) - len(valid)
+    hashes = [url_hash(longurl) for longurl, _ in valid]
+    found = storage.find_by_hashes(list(set(hashes)))
+
+    with_code = {}
+    generate = {}
+    seen = set()
+    for longurl_hash, (longurl, shorturl) in zip(hashes, valid):
+        if longurl_hash in found and longurl_hash not in seen and replay_after is not None \
+                and found[longurl_hash][0] > replay_after:
+            # Stored by the interrupted attempt at this batch
+            seen.add(longurl_hash)
+            stats['created'] += 1
+            if isinstance(shorturl, str) and found[longurl_hash][1] != shorturl:
+                stats['conflicts'] += 1
+            continue
+        if longurl_hash in found or longurl_hash in seen:
+            stats['existing'] += 1
+            continue
+        seen.add(longurl_hash)
+        if isinstance(shorturl, str) and usable_code(shorturl, reserved):
+            with_code[longurl_hash] = (longurl, shorturl)
+        else:
+            if isinstance(shorturl, str):
+                stats['conflicts'] += 1
+            generate[longurl_hash] = longurl
+
+    if with_code:
+        storage.insert_many([(longurl, shorturl, longurl_hash)
+                             for longurl_hash, (longurl, shorturl) in with_code.items()])
+        stored = storage.find_by_hashes(list(with_code))
+        for longurl_hash, (longurl, shorturl) in with_code.items():
+            if longurl_hash not in stored:
+                stats['conflicts'] += 1
+                generate[longurl_hash] = longurl
+            elif stored[longurl_hash][1] == shorturl:
+                stats['created'] += 1
+            else:
+                stats['existing'] += 1
+
+    if generate:
+        for _, _, created in storage.create_many(list(generate.values()), list(generate)):
+            stats['created' if created else 'existing'] += 1
+    stats['rows'] += len(records)
+
+
+def import_file(storage, path, fmt=None, batch_size=10000, resume=False, progress=None, reserved=()):
+    """Import ``path`` into ``storage`` and return the row counts.
+
+    ``progress`` is called with the counts and elapsed seconds after every
+    batch. Supplied codes in ``reserved`` are replaced, see ``usable_code``.
+    """
+    fmt = detect_format(path, fmt)
+    checkpoint = checkpoint_path(path)
+    stats = {"rows": 0, "created": 0, "existing": 0, "conflicts": 0, "invalid": 0}
+    offset = 0
+    replay_after = None
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        offset = saved.pop('offset')
+        replay_after = saved.pop('stored_after', None)
+        stats.update(saved)
+
+    def save(offset):
+        temporary = checkpoint + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(dict(stats, offset=offset, stored_after=last_link_id(storage)), checkpoint_file)
+        os.replace(temporary, checkpoint)
+
+    if replay_after is None:
+        # Lets a run interrupted during its first batch resume too
+        save(offset)
+    started = time.perf_counter()
+    with open(path, 'rb') as stream:
+        for records, offset in read_batches(stream, fmt, batch_size, offset):
+            import_batch(storage, records, stats, replay_after, reserved)
+            replay_after = None
+            save(offset)
+            if progress:
+                progress(stats, time.perf_counter() - started)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return stats
+
+
+def last_exported_id(path, fmt):
+    """Id of the last complete row in ``path``, dropping any partial line."""
+    with open(path, 'rb+') as output:
+        size = output.seek(0, io.SEEK_END)
+        end = size
+        block = b''
+        while end > 0 and block.count(b'\n') < 2:
+            start = max(0, end - 65536)
+            output.seek(start)
+            block = output.read(end - start) + block
+            end = start
+        complete = block[:block.rfind(b'\n') + 1]
+        if len(complete) < len(block):
+            output.truncate(size - (len(block) - len(complete)))
+    lines = complete.splitlines()
+    if not lines:
+        return 0
+    last = lines[-1].decode('utf-8')
+    if fmt == 'csv':
+        value = next(csv.reader([last]))[0]
+        return int(value) if value.isdigit() else 0
+    return int(json.loads(last)['id'])
+
+
+def export_file(storage, path, fmt=None, batch_size=10000, resume=False, progress=None):
+    """Write every link to ``path`` in id order and return the row count."""
+    fmt = detect_format(path, fmt)
+    after = 0
+    if resume and os.path.exists(path) and os.path.getsize(path):
+        after = last_exported_id(path, fmt)
+        mode = 'a'
+    else:
+        mode = 'w'
+    rows = 0
+    started = time.perf_counter()
+    with open(path, mode, newline='', encoding='utf-8') as output:
+        writer = csv.writer(output, lineterminator='\n') if fmt == 'csv' else None
+        if writer and mode == 'w':
+            writer.writerow(EXPORT_COLUMNS)
+        batch = []
+        for row in storage.iter_urls(after, None, batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                rows += _write_batch(output, writer, batch)
+                batch = []
+                if progress:
+                    progress(rows, time.perf_counter() - started)
+        rows += _write_batch(output, writer, batch)
+    if progress:
+        progress(rows, time.perf_counter() - started)
+    return rows
+
+
+def _write_batch(output, writer, rows):
+    if writer is not None:
+        writer.writerows((row[0], row[1], row[2]) for row in rows)
+    else:
+        output.write(''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows))
+    output.flush()
+    return len(rows)